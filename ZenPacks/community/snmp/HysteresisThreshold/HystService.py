@@ -0,0 +1,269 @@
+__doc__ = """HystService
+Connections to a hysteresis state service shared by several collectors.
+
+The service is any server speaking the Redis protocol (Redis 4 or later).
+The state of a device/threshold pair is the hash hyst:<device>:<threshold>,
+which maps hystCountKey to the encoded HystWindow and _version to the
+number of saves made to the hash.  ZENHYST_SERVICE picks
+the service:
+
+    redis://host:port/db    a Redis server
+    file:///path/state.db   a local sqlite file answering the same
+                            commands, to try things out without a server
+
+Commands are sent in pipelines: all of them are written at once and the
+replies are read afterwards, so a batch costs one round trip.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+from urlparse import urlparse
+
+from Products.ZenUtils.Utils import zenPath
+
+import logging
+log = logging.getLogger('zen.HysteresisThreshold')
+
+DEFAULT_URL = 'redis://localhost:6379/0'
+
+# Seconds to wait for the service before giving up on a request.
+TIMEOUT = float(os.environ.get('ZENHYST_SERVICE_TIMEOUT', 2))
+
+# Idle connections kept open per service.
+POOL_SIZE = int(os.environ.get('ZENHYST_SERVICE_POOL', 4))
+
+
+class HystServiceError(Exception):
+    """The service answered a command with an error.
+    """
+
+
+class HystServiceUnavailable(HystServiceError):
+    """The service could not be reached.
+    """
+
+
+def encodeCommand(args):
+    """A command in the Redis protocol.
+    """
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+class RespConnection(object):
+    """
+    Connection to a server speaking the Redis protocol.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=TIMEOUT):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._file = self._sock.makefile('rb')
+        if db:
+            self.execute([('SELECT', db)])
+
+    def execute(self, commands):
+        """Send commands in one pipeline and return their replies.
+        """
+        self._sock.sendall(''.join(encodeCommand(c) for c in commands))
+        replies = [self._reply() for c in commands]
+        for reply in replies:
+            if isinstance(reply, HystServiceError):
+                raise reply
+        return replies
+
+    def _reply(self):
+        line = self._file.readline()
+        if not line.endswith('\r\n'):
+            raise socket.error("connection closed by the service")
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            return rest
+        if kind == '-':
+            # Raised once all replies of the pipeline are read.
+            return HystServiceError(rest)
+        if kind == ':':
+            return int(rest)
+        if kind == '$':
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self._file.read(size + 2)
+            if len(data) != size + 2:
+                raise socket.error("connection closed by the service")
+            return data[:-2]
+        if kind == '*':
+            size = int(rest)
+            if size < 0:
+                return None
+            return [self._reply() for i in xrange(size)]
+        raise HystServiceError("unexpected reply %r" % line)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class FileConnection(object):
+    """
+    Stand-in for the service that keeps the hashes in a local sqlite
+    file.  It understands the commands the state store sends.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The pool hands a connection to one thread at a time, but not
+        # always to the thread that opened it.
+        self._db = sqlite3.connect(path, timeout=TIMEOUT,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hyst_hash ("
+            " name TEXT NOT NULL,"
+            " field TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " PRIMARY KEY (name, field))")
+        self._db.commit()
+
+    def execute(self, commands):
+        calls = []
+        for command in commands:
+            method = getattr(self, '_' + command[0].lower(), None)
+            if method is None:
+                raise HystServiceError("unknown command %s" % command[0])
+            calls.append((method, command[1:]))
+        try:
+            with self._db:
+                return [call(*args) for call, args in calls]
+        except sqlite3.Error as e:
+            raise HystServiceUnavailable(str(e))
+
+    def _ping(self):
+        return 'PONG'
+
+    def _select(self, db):
+        return 'OK'
+
+    def _hgetall(self, name):
+        reply = []
+        for field, value in self._db.execute(
+                "SELECT field, value FROM hyst_hash WHERE name = ?",
+                (name,)):
+            reply.extend((field, str(value)))
+        return reply
+
+    def _hset(self, name, *pairs):
+        rows = [(name, pairs[i], sqlite3.Binary(pairs[i + 1]))
+                for i in xrange(0, len(pairs), 2)]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO hyst_hash (name, field, value)"
+            " VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def _hstrlen(self, name, field):
+        row = self._db.execute(
+            "SELECT length(value) FROM hyst_hash WHERE name = ? AND field = ?",
+            (name, field)).fetchone()
+        return row[0] if row else 0
+
+    def _hdel(self, name, *fields):
+        return sum(self._db.execute(
+            "DELETE FROM hyst_hash WHERE name = ? AND field = ?",
+            (name, field)).rowcount for field in fields)
+
+    def _del(self, *names):
+        return sum(min(1, self._db.execute(
+            "DELETE FROM hyst_hash WHERE name = ?", (name,)).rowcount)
+            for name in names)
+
+    def _hget(self, name, field):
+        row = self._db.execute(
+            "SELECT value FROM hyst_hash WHERE name = ? AND field = ?",
+            (name, field)).fetchone()
+        return str(row[0]) if row else None
+
+    def _hincrby(self, name, field, amount):
+        value = int(self._hget(name, field) or 0) + int(amount)
+        self._hset(name, field, str(value))
+        return value
+
+    def close(self):
+        self._db.close()
+
+
+class ConnectionPool(object):
+    """
+    Reuses up to size idle connections made by factory.  A connection
+    that fails is dropped and the request is tried once more on a new one.
+    """
+
+    def __init__(self, factory, size=POOL_SIZE):
+        self.factory = factory
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def execute(self, commands):
+        """Send commands in one pipeline and return their replies.
+        """
+        for attempt in (1, 2):
+            connection = self._get()
+            try:
+                replies = connection.execute(commands)
+            except (socket.error, IOError, EOFError) as e:
+                self._discard(connection)
+                if attempt == 2:
+                    raise HystServiceUnavailable(str(e))
+                continue
+            except HystServiceError:
+                self._release(connection)
+                raise
+            self._release(connection)
+            return replies
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self.factory()
+        except (socket.error, IOError, sqlite3.Error) as e:
+            raise HystServiceUnavailable(str(e))
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+
+def connect(url=DEFAULT_URL, size=POOL_SIZE):
+    """Connection pool for a service URL.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        path = parsed.path or zenPath('var', 'hystService.db')
+        return ConnectionPool(lambda: FileConnection(path), size)
+    if parsed.scheme == 'redis':
+        host = parsed.hostname or 'localhost'
+        port = parsed.port or 6379
+        db = int(parsed.path.strip('/') or 0)
+        return ConnectionPool(lambda: RespConnection(host, port, db), size)
+    raise ValueError("unsupported hysteresis state service %r" % url)
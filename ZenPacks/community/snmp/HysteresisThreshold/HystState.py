@@ -0,0 +1,708 @@
+__doc__ = """HystState
+In-memory hysteresis state and its write-behind persistence.
+
+The state of a device/threshold pair lives in a HystStateEntry kept by
+the process-wide registry.  Every HystThresholdInstance for that pair,
+including the ones rebuilt by a config push, attaches to the same entry,
+so only the first of them reads the store.  Entries idle for longer than
+ZENHYST_CACHE_TTL seconds, and the least recently used ones while the
+entries take more than ZENHYST_CACHE_MB megabytes, are saved and dropped.
+
+When the first thresholds arrive from zenhub, a thread reads the whole
+store at once (preload()), so that the first polling cycle after a
+restart doesn't read it pair by pair.  Checks that come earlier wait for
+it, and preloaded state no pair attaches to within ZENHYST_CACHE_TTL is
+dropped again.
+
+Once every ZENHYST_COMPACT_INTERVAL seconds the keys the store holds are
+compared with those of the configured threshold instances.  The state of
+a datapoint no instance checks any more, because its threshold, datapoint
+or device was removed, is deleted once it has been orphaned for longer
+than ZENHYST_CACHE_TTL seconds.  Stores that hold the state of other
+processes too are left alone, see HystStateStore.exclusive().
+
+Instances only tell the writer that an entry has changed.  Once per
+flush interval the writer copies the changed windows and hands the copies
+to a thread of the reactor's pool, which saves them in one batch, so
+checks never wait for the store.  Changes copied while a save is running
+are merged per key and saved together after it.  At shutdown everything
+is saved before the reactor stops.
+"""
+
+import os
+import time
+import atexit
+import bisect
+import weakref
+import threading
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import \
+    getStore, resetStore, keyRange
+from ZenPacks.community.snmp.HysteresisThreshold.HystStats import stats
+
+import logging
+log = logging.getLogger('zen.HysteresisThreshold')
+
+# Seconds between two flushes of changed state.  Zero (or less) makes
+# every change go to disk immediately, which is how the ZenPack used to work.
+FLUSH_INTERVAL = float(os.environ.get('ZENHYST_FLUSH_INTERVAL', 60))
+
+# Entries not used for this many seconds are dropped from memory, which
+# is what eventually happens to the state of removed devices.
+CACHE_TTL = float(os.environ.get('ZENHYST_CACHE_TTL', 6 * 3600))
+
+# Memory the entries may take, zero for no limit.
+CACHE_BYTES = int(float(os.environ.get('ZENHYST_CACHE_MB', 128)) * 2 ** 20)
+
+# Read all state at startup, in the background, rather than device by
+# device on first use, with this many threads where the store can use them.
+PRELOAD = os.environ.get('ZENHYST_PRELOAD', '1') not in ('', '0')
+PRELOAD_THREADS = int(os.environ.get('ZENHYST_PRELOAD_THREADS', 4))
+
+# Seconds between two eviction passes.
+SWEEP_INTERVAL = 60
+
+# Seconds between two compaction passes, zero for none.
+COMPACT_INTERVAL = float(os.environ.get('ZENHYST_COMPACT_INTERVAL', 3600))
+
+# Rough size of an entry and of every window in it, besides its
+# measurements.
+ENTRY_BYTES = 400
+WINDOW_BYTES = 220
+
+
+class HystStateEntry(object):
+    """
+    Hysteresis state of one device/threshold pair: its windows keyed by
+    hystCountKey, which hold the flags and escalation counts too, the last
+    events sent keyed by countKey, and the keys changed since the last
+    save.
+    """
+
+    __slots__ = ('key', 'hystCount', 'emitted', 'dirty', 'used', 'live')
+
+    def __init__(self, key, hystCount):
+        self.key = key
+        self.hystCount = hystCount
+        self.emitted = {}
+        self.dirty = set()
+        self.used = time.time()
+        # False once evicted: attached instances then attach again.
+        self.live = True
+
+    def changes(self, full=False):
+        """Hand the changed datapoints over to the state store, as a
+        (device, threshold, windows, changed keys) record holding copies
+        of the changed windows, or of all of them when full is set.
+        """
+        hystCount = self.hystCount
+        changed = set(self.dirty)
+        # Cleared in place, the attached instances share the set.
+        self.dirty.clear()
+        windows = dict((key, hystCount[key].copy())
+                       for key in (hystCount if full else changed)
+                       if key in hystCount)
+        device, threshold = self.key
+        return (device, threshold, windows, changed)
+
+    def size(self):
+        """Estimate of the memory the entry keeps alive.
+        """
+        return ENTRY_BYTES + sum(WINDOW_BYTES + window.nbytes
+                                 for window in self.hystCount.itervalues())
+
+
+class HystStateWriter(object):
+    """
+    Keeps track of entries with unsaved hysteresis state and saves them
+    on a timer, in a thread.
+    """
+
+    # Flush on a reactor timer.  Without one the owner of the writer
+    # calls flush() itself.
+    useReactor = True
+
+    def __init__(self, interval=FLUSH_INTERVAL, store=None):
+        self.interval = interval
+        self._store = store
+        self._dirty = {}
+        # (device, threshold) -> (windows, changed keys) waiting for a save
+        self._queued = {}
+        # The same for the save running in a thread.
+        self._inFlight = {}
+        self._writing = False
+        # Clear while a save runs in a thread.
+        self._saved = threading.Event()
+        self._saved.set()
+        self._call = None
+        self._triggers = False
+        # Held by whatever thread uses the store.
+        self.lock = threading.RLock()
+
+    def reset(self):
+        """Drop the unsaved changes and the store without saving or
+        closing anything, and start over.
+        """
+        resetStore()
+        self._store = None
+        self._dirty = {}
+        self._queued = {}
+        self._inFlight = {}
+        self._writing = False
+        self._saved = threading.Event()
+        self._saved.set()
+        self._call = None
+        self.lock = threading.RLock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = getStore()
+        return self._store
+
+    def markDirty(self, key, entry):
+        """Remember that entry has state that is not saved yet.
+        """
+        self._dirty[key] = entry
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._schedule()
+
+    def isDirty(self, key):
+        return key in self._dirty or key in self._queued
+
+    def detach(self, key):
+        """Copy the changes of an entry that is going away into the
+        queue, to be saved with the next flush.
+        """
+        entry = self._dirty.pop(key, None)
+        if entry is not None:
+            self._queue([entry])
+            self._schedule()
+
+    def load(self, device, threshold):
+        """State of a device/threshold pair as the store has it, with
+        the changes of the pair that are still being saved or waiting
+        for a save on top.  A running save is not waited for, only a
+        migration of old pickle files takes the lock.
+        """
+        key = (device, threshold)
+        store = self.store
+        hystCount = store.read(device, threshold)
+        if not hystCount and store.hasLegacy(device, threshold):
+            with self.lock:
+                hystCount = store.load(device, threshold)
+        for changes in (self._inFlight.get(key), self._queued.get(key)):
+            if changes is not None:
+                windows, changed = changes
+                for hystKey in changed.intersection(windows):
+                    hystCount[hystKey] = windows[hystKey].copy()
+        return hystCount
+
+    def flush(self, key=None):
+        """Save changed state right away, either for one key or for all
+        of them.  A save running in a thread is waited for, so that it
+        can't overwrite newer state afterwards.
+        """
+        self.waitForSave()
+        records = self._take(key)
+        if records:
+            registry.refresh(self._write(records))
+
+    def waitForSave(self):
+        """Wait for a save running in a thread, if there is one.
+        """
+        self._saved.wait()
+
+    def flushInBackground(self):
+        """Save changed state in a thread of the reactor's pool.
+        """
+        if self._writing:
+            # Saved by _written() once the running save is done.
+            self._queue(self._dirty.itervalues())
+            self._dirty = {}
+            return
+        records = self._take()
+        if not records:
+            return
+        try:
+            from twisted.internet.threads import deferToThread
+        except ImportError:
+            registry.refresh(self._write(records))
+            return
+        self._writing = True
+        self._saved.clear()
+        self._inFlight = dict(((device, threshold), (windows, changed))
+                              for device, threshold, windows, changed
+                              in records)
+        deferToThread(self._writeInThread, records).addBoth(self._written)
+
+    def _writeInThread(self, records):
+        try:
+            return self._write(records)
+        finally:
+            self._saved.set()
+
+    def _written(self, result):
+        self._writing = False
+        self._inFlight = {}
+        if isinstance(result, dict):
+            registry.refresh(result)
+        if self._queued:
+            self.flushInBackground()
+
+    def _queue(self, entries):
+        full = self.store.fullState
+        for entry in entries:
+            device, threshold, windows, changed = entry.changes(full)
+            queued = self._queued.get(entry.key)
+            if queued is None:
+                self._queued[entry.key] = (windows, changed)
+            else:
+                queued[0].update(windows)
+                queued[1].update(changed)
+
+    def _take(self, key=None):
+        """Records of the queued and dirty state of key, or of all keys.
+        """
+        if key is not None:
+            entry = self._dirty.pop(key, None)
+            if entry is not None:
+                self._queue([entry])
+            queued = self._queued.pop(key, None)
+            items = [(key, queued)] if queued is not None else []
+        else:
+            self._queue(self._dirty.itervalues())
+            self._dirty = {}
+            items, self._queued = self._queued.items(), {}
+        return [(device, threshold, windows, changed)
+                for (device, threshold), (windows, changed) in items]
+
+    def _write(self, records):
+        """Save records, return the windows other writers saved in the
+        meantime, see HystStateStore.takeRefreshed().
+        """
+        with self.lock:
+            log.debug("flushing hysteresis state of %d thresholds",
+                      len(records))
+            started = time.time()
+            try:
+                self.store.save(records)
+            except Exception:
+                log.exception("unable to save hysteresis state")
+            stats.saveTime += time.time() - started
+            stats.saves += 1
+            stats.rowsSaved += sum(len(record[-1]) for record in records)
+            return self.store.takeRefreshed()
+
+    def _flushLater(self):
+        self._call = None
+        self.flushInBackground()
+        registry.sweepIfDue()
+        registry.compactIfDue()
+
+    def queuedKeys(self, key):
+        """hystCountKeys of a pair with changes waiting for a save.
+        """
+        queued = self._queued.get(key)
+        return queued[1] if queued is not None else ()
+
+    def forget(self, keys):
+        """Drop hystCountKeys from the changes waiting for a save.
+        """
+        for windows, changed in self._queued.itervalues():
+            changed.difference_update(keys)
+            for key in keys.intersection(windows):
+                del windows[key]
+
+    def _schedule(self):
+        if not self._triggers:
+            self._triggers = True
+            atexit.register(self.flush)
+            try:
+                from twisted.internet import reactor
+                reactor.addSystemEventTrigger('before', 'shutdown',
+                                              self.flush)
+            except ImportError:
+                pass
+        if self._call is not None or not self.useReactor:
+            return
+        try:
+            from twisted.internet import reactor
+            self._call = reactor.callLater(self.interval, self._flushLater)
+        except ImportError:
+            # No reactor to flush on: fall back to saving right away.
+            self.flush()
+
+
+class HystStateRegistry(object):
+    """
+    Process-wide map of (device, threshold) to HystStateEntry, with
+    TTL and least recently used eviction.
+    """
+
+    def __init__(self, writer, ttl=CACHE_TTL, budget=CACHE_BYTES):
+        self.writer = writer
+        self.ttl = ttl
+        self.budget = budget
+        self._entries = {}
+        self._swept = time.time()
+        # The threshold instances of the daemon, which tell compact()
+        # what state is still used.
+        self.instances = weakref.WeakSet()
+        self._compacted = time.time()
+        self._compacting = False
+        # hystCountKey -> when compact() first found it orphaned
+        self._orphaned = {}
+        # Windows read by preload() whose pair is not attached yet, keyed
+        # by hystCountKey, and all their keys in order.
+        self._preloaded = {}
+        self._preloadedKeys = []
+        self._preloadedAt = 0
+        self._preloadStarted = False
+        # Clear while preload() runs.
+        self._preloadDone = threading.Event()
+        self._preloadDone.set()
+        # Pairs attached from the daemon's copy of a shared store that
+        # fetch() has to read again, and whether it is running.
+        self._toFetch = set()
+        self._fetching = False
+
+    def attach(self, device, threshold):
+        """Entry of a device/threshold pair, read from the store if it
+        is not in memory yet.
+        """
+        key = (device, threshold)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.waitForPreload()
+            hystCount = self._takePreloaded(device, threshold)
+            fetch = False
+            if hystCount is None:
+                hystCount = self.writer.load(device, threshold)
+                stats.loadTime += time.time() - now
+                stats.loads += 1
+                fetch = self.writer.store.shared
+            entry = self._entries[key] = HystStateEntry(key, hystCount)
+            if fetch:
+                self._fetchLater(key)
+        else:
+            stats.reattached += 1
+        entry.used = now
+        self.sweepIfDue(now)
+        return entry
+
+    def preload(self, threads=PRELOAD_THREADS):
+        """Read the whole store, so that pairs attached later on don't
+        have to be read one by one.  Meant for startup, before the first
+        polling cycle.
+        """
+        started = time.time()
+        with self.writer.lock:
+            windows, skipped = self.writer.store.loadAll(threads)
+        keys = sorted(windows)
+        # Pairs attached in the meantime have newer state.
+        for device, threshold in self._entries.keys():
+            low, high = keyRange(device, threshold)
+            for i in xrange(bisect.bisect_left(keys, low),
+                            bisect.bisect_left(keys, high)):
+                windows.pop(keys[i], None)
+        self._preloadedAt = time.time()
+        self._preloadedKeys = keys
+        self._preloaded = windows
+        elapsed = self._preloadedAt - started
+        stats.preloaded += len(windows)
+        stats.unreadable += skipped
+        stats.preloadTime += elapsed
+        log.info("preloaded the hysteresis state of %d datapoints in %.2fs,"
+                 " skipped %d unreadable ones", len(windows), elapsed,
+                 skipped)
+
+    def preloadInBackground(self):
+        """Run preload() once, in a thread.  Pairs attached until it is
+        done wait for it.
+        """
+        if self._preloadStarted:
+            return
+        self._preloadStarted = True
+        self._preloadDone.clear()
+
+        def run():
+            try:
+                self.preload()
+            except Exception:
+                log.exception("unable to preload hysteresis state")
+            finally:
+                self._preloadDone.set()
+        thread = threading.Thread(target=run, name='zenhyst-preload')
+        thread.daemon = True
+        thread.start()
+
+    def waitForPreload(self):
+        """Wait for preload() running in a thread, if it is.
+        """
+        self._preloadDone.wait()
+
+    def _takePreloaded(self, device, threshold):
+        """Preloaded windows of a pair, None when there are none.
+        """
+        keys = self._preloadedKeys
+        if not keys:
+            return None
+        low, high = keyRange(device, threshold)
+        windows = self._preloaded
+        hystCount = {}
+        for i in xrange(bisect.bisect_left(keys, low),
+                        bisect.bisect_left(keys, high)):
+            window = windows.pop(keys[i], None)
+            if window is not None:
+                hystCount[keys[i]] = window
+        if not windows:
+            self._preloadedKeys = []
+        return hystCount or None
+
+    def _dropPreloaded(self):
+        self._preloaded = {}
+        self._preloadedKeys = []
+
+    def refresh(self, refreshed):
+        """Take the windows another collector saved, unless the daemon
+        changed them since its last save.
+        """
+        for key, windows in refreshed.iteritems():
+            entry = self._entries.get(key)
+            if entry is None:
+                for hystKey, window in windows.iteritems():
+                    if hystKey in self._preloaded:
+                        self._preloaded[hystKey] = window
+                continue
+            skip = entry.dirty.union(self.writer.queuedKeys(key))
+            for hystKey, window in windows.iteritems():
+                if hystKey not in skip:
+                    entry.hystCount[hystKey] = window
+                    stats.refreshed += 1
+
+    def _fetchLater(self, key):
+        """Read a pair from the shared store in a thread, see
+        HystStateStore.fetch().  Pairs attached while it runs are read
+        right after it.
+        """
+        self._toFetch.add(key)
+        if self._fetching:
+            return
+        pairs, self._toFetch = self._toFetch, set()
+        self._fetching = True
+        self._inThread(self._fetch, (pairs,), self._fetched)
+
+    def _fetch(self, pairs):
+        try:
+            with self.writer.lock:
+                return self.writer.store.fetch(pairs)
+        except Exception:
+            log.exception("unable to read shared hysteresis state")
+
+    def _fetched(self, fetched):
+        """Take the windows fetch() read.  They are newer than the
+        daemon's copy the pairs were attached from, so they also replace
+        what the daemon changed since.
+        """
+        self._fetching = False
+        if isinstance(fetched, dict):
+            replaced = set()
+            for key, windows in fetched.iteritems():
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                entry.hystCount.update(windows)
+                entry.dirty.difference_update(windows)
+                replaced.update(windows)
+                stats.refreshed += len(windows)
+            if replaced:
+                self.writer.forget(replaced)
+        if self._toFetch:
+            self._fetchLater(self._toFetch.pop())
+
+    def evict(self, key):
+        """Forget the state of a device/threshold pair, e.g. when the
+        device was removed.  Its changes are saved with the next flush.
+        """
+        self.writer.detach(key)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.live = False
+            stats.evicted += 1
+
+    def clear(self):
+        """Save and forget all state.
+        """
+        self.writer.flush()
+        for entry in self._entries.itervalues():
+            entry.live = False
+        self._entries.clear()
+        self._dropPreloaded()
+
+    def reset(self):
+        """Forget all state without saving it, see HystStateWriter.reset().
+        """
+        for entry in self._entries.itervalues():
+            entry.live = False
+        self._entries = {}
+        self._orphaned = {}
+        self._compacting = False
+        self._toFetch = set()
+        self._fetching = False
+        self.waitForPreload()
+        self._preloadStarted = False
+        self._dropPreloaded()
+        self._preloadStarted = False
+        self._preloadDone = threading.Event()
+        self._preloadDone.set()
+
+    def sweepIfDue(self, now=None):
+        if now is None:
+            now = time.time()
+        if now - self._swept > SWEEP_INTERVAL:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Drop idle entries, then the least recently used ones until
+        the rest fits the memory budget.
+        """
+        if now is None:
+            now = time.time()
+        self._swept = now
+        if self._preloaded and now - self._preloadedAt > self.ttl:
+            # Left over from removed devices; the store still has them.
+            self._dropPreloaded()
+        for key, entry in self._entries.items():
+            if now - entry.used > self.ttl:
+                self.evict(key)
+        if not self.budget:
+            return
+        sizes = [(entry.used, key, entry.size())
+                 for key, entry in self._entries.iteritems()]
+        total = sum(size for used, key, size in sizes)
+        if total <= self.budget:
+            return
+        log.info("hysteresis state takes %d bytes, over its budget of %d",
+                 total, self.budget)
+        sizes.sort()
+        for used, key, size in sizes:
+            self.evict(key)
+            total -= size
+            if total <= self.budget:
+                break
+
+    def compactIfDue(self, now=None):
+        if now is None:
+            now = time.time()
+        if COMPACT_INTERVAL > 0 and not self._compacting and \
+                now - self._compacted > COMPACT_INTERVAL:
+            self.compact(now)
+
+    def compact(self, now=None):
+        """Delete the state of datapoints that no configured threshold
+        instance checks any more and that were found orphaned more than
+        the TTL ago.  The store is read and written in threads.
+        """
+        if now is None:
+            now = time.time()
+        self._compacted = now
+        configured = set()
+        for instance in list(self.instances):
+            configured.update(instance.configuredKeys())
+        if not configured:
+            # Before the config arrives everything would look orphaned.
+            return
+        self._compacting = True
+        self._inThread(self._storedKeys, (),
+                       lambda stored: self._compactKeys(stored, configured,
+                                                        now))
+
+    def _inThread(self, function, args, callback):
+        try:
+            from twisted.internet.threads import deferToThread
+        except ImportError:
+            deferToThread = None
+        if deferToThread is None or not self.writer.useReactor:
+            callback(function(*args))
+            return
+        deferToThread(function, *args).addBoth(callback)
+
+    def _storedKeys(self):
+        started = time.time()
+        try:
+            with self.writer.lock:
+                store = self.writer.store
+                if store.exclusive():
+                    return store.keys()
+        except Exception:
+            log.exception("unable to list the hysteresis state")
+        finally:
+            stats.compactTime += time.time() - started
+
+    def _compactKeys(self, stored, configured, now):
+        """Find the expired orphans among the stored keys and those in
+        memory, forget them and delete them from the store.
+        """
+        if not isinstance(stored, list):
+            self._compacting = False
+            return
+        stats.compactions += 1
+        keys = set(stored)
+        for entry in self._entries.itervalues():
+            keys.update(entry.hystCount)
+        orphaned = {}
+        for key in keys.difference(configured):
+            orphaned[key] = self._orphaned.get(key, now)
+        self._orphaned = orphaned
+        expired = set(key for key, since in orphaned.iteritems()
+                      if now - since > self.ttl)
+        if not expired:
+            self._compacting = False
+            return
+        # Nothing may save them again once they are deleted.
+        for entry in self._entries.itervalues():
+            for key in expired.intersection(entry.hystCount):
+                del entry.hystCount[key]
+                entry.dirty.discard(key)
+        self.writer.forget(expired)
+        for key in expired:
+            self._preloaded.pop(key, None)
+            del orphaned[key]
+        self._inThread(self._deleteKeys, (expired,), self._compactDone)
+
+    def _deleteKeys(self, keys):
+        started = time.time()
+        # A save that took the keys before they were forgotten goes first.
+        self.writer.waitForSave()
+        try:
+            with self.writer.lock:
+                deleted, size = self.writer.store.deleteKeys(keys)
+        except Exception:
+            log.exception("unable to delete orphaned hysteresis state")
+            return None
+        stats.compactTime += time.time() - started
+        return deleted, size
+
+    def _compactDone(self, result):
+        self._compacting = False
+        if not isinstance(result, tuple):
+            return
+        deleted, size = result
+        stats.reclaimedEntries += deleted
+        stats.reclaimedBytes += size
+        log.info("deleted the hysteresis state of %d orphaned datapoints,"
+                 " %d bytes", deleted, size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+stateWriter = HystStateWriter()
+registry = HystStateRegistry(stateWriter)
@@ -0,0 +1,100 @@
+__doc__ = """HystStats
+Counters of the work done by hysteresis thresholds in this process.
+
+The counters are plain attributes of the module-level stats object, so
+updating them costs an attribute increment.  A collector can read
+stats.snapshot() and report the values as its own datapoints; sending
+the daemon ZENHYST_STATS_SIGNAL (SIGUSR2 by default) logs them.
+"""
+
+import os
+import signal
+
+import logging
+log = logging.getLogger('zen.HysteresisThreshold')
+
+
+class HystStats(object):
+    """
+    Process-wide counters and timers of the hysteresis thresholds.
+    """
+
+    COUNTERS = (
+        'samples',       # values that went through checkRange()
+        'violations',    # events sent with the threshold's severity
+        'notices',       # severity 2 events sent for bad values under N of M
+        'escalations',   # violations sent escalated by escalateCount
+        'clears',        # clear events sent
+        'heldClears',    # good values waiting for K in a row
+        'suppressedEvents',  # repeated violations and notices not sent
+        'suppressedClears',  # repeated clear events not sent
+        'loads',         # device/threshold states loaded from the store
+        'preloaded',     # datapoint states read by the startup preload
+        'unreadable',    # datapoint states the preload could not read
+        'reattached',    # instances given state already in memory
+        'evicted',       # device/threshold states dropped from memory
+        'compactions',   # passes looking for state of removed datapoints
+        'reclaimedEntries',  # datapoint states they deleted
+        'reclaimedBytes',    # bytes freed by them and by shrunk windows
+        'saves',         # batches handed to the store
+        'rowsSaved',     # datapoint states in those batches
+        'bytesWritten',  # encoded state bytes handed to the store
+        'serviceErrors',  # failed requests to the shared state service
+        'refreshed',     # datapoint states taken from other collectors
+    )
+    TIMERS = (
+        'checkTime',     # seconds spent in checkRange()/checkRangeBatch()
+        'loadTime',      # seconds spent reading state from the store
+        'preloadTime',   # seconds spent preloading state at startup
+        'saveTime',      # seconds spent saving state
+        'compactTime',   # seconds spent in compaction passes
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.TIMERS:
+            setattr(self, name, 0.0)
+
+    def snapshot(self):
+        """Current values as a dictionary.
+        """
+        return dict((name, getattr(self, name))
+                    for name in self.COUNTERS + self.TIMERS)
+
+    def report(self):
+        return ', '.join('%s=%s' % (name, getattr(self, name))
+                         for name in self.COUNTERS + self.TIMERS)
+
+
+stats = HystStats()
+
+_installed = False
+
+
+def installSignalHandler():
+    """Log the counters when the daemon gets ZENHYST_STATS_SIGNAL.
+    A handler the daemon installed before is still called afterwards.
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    name = os.environ.get('ZENHYST_STATS_SIGNAL', 'SIGUSR2')
+    signum = getattr(signal, name, None) if name else None
+    if signum is None:
+        return
+    try:
+        previous = signal.getsignal(signum)
+
+        def handler(signum, frame):
+            log.info("hysteresis threshold stats: %s", stats.report())
+            if callable(previous):
+                previous(signum, frame)
+        signal.signal(signum, handler)
+    except ValueError:
+        # Signals can only be set up from the main thread.
+        log.debug("not installing the hysteresis stats signal handler")
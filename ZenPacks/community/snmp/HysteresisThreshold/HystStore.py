@@ -0,0 +1,1008 @@
+__doc__ = """HystStore
+Storage backends for hysteresis state.
+
+A store loads the state of one device/threshold pair and saves the
+changed datapoints of many pairs at once.  The state of a pair is the
+hystCount dictionary of HystThresholdInstance, which maps hystCountKey
+to a HystWindow or HystTimeWindow.
+
+Saves run in a thread of the reactor's pool.  The state writer holds
+its lock whenever it uses the store, so a store is used by one thread at
+a time, though not always by the same one.  The exception is read(),
+which the reactor thread calls without the lock while a save may be
+running.
+"""
+
+import os
+import sys
+import time
+import threading
+import zlib
+import fcntl
+import struct
+import sqlite3
+import cPickle as pickle
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from Products.ZenUtils.Utils import zenPath, atomicWrite
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystTimeWindow, asWindow, decode
+from ZenPacks.community.snmp.HysteresisThreshold.HystStats import stats
+from ZenPacks.community.snmp.HysteresisThreshold.HystService import \
+    connect, HystServiceError, DEFAULT_URL
+
+import logging
+log = logging.getLogger('zen.HysteresisThreshold')
+
+
+class HystStoreLocked(Exception):
+    """Another process has the store open.
+    """
+
+
+# Collector the daemon runs for, as given to its --monitor option.  Daemons
+# of the same name checking for several collectors on one host keep their
+# state files apart by it.
+MONITOR = os.environ.get('ZENHYST_MONITOR', '')
+
+
+def daemonName():
+    """Name of the running daemon, e.g. zenperfsnmp.
+    """
+    name = os.path.splitext(os.path.basename(sys.argv[0] or ''))[0]
+    return name or 'zenhyst'
+
+
+def stateName():
+    """Prefix of the daemon's state files: its name, followed by the
+    collector's with ZENHYST_MONITOR set, e.g. zenperfsnmp-remote1.
+    """
+    if MONITOR:
+        return '%s-%s' % (daemonName(), MONITOR)
+    return daemonName()
+
+
+def keyRange(device, threshold):
+    """First and last hystCountKey (exclusive) of a device/threshold pair.
+    """
+    prefix = '%s:%s:' % (device, threshold)
+    return prefix, prefix[:-1] + chr(ord(':') + 1)
+
+
+def _syncDirectory(path):
+    """Flush the entries of the directory holding path to disk, so that
+    a file renamed there stays renamed after a crash.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _decodeAll(rows):
+    """Decode (hystCountKey, encoded window) rows for loadAll().
+    """
+    windows = {}
+    skipped = 0
+    for key, state in rows:
+        try:
+            windows[key] = decode(str(state))
+        except Exception:
+            log.warn("skipping unreadable hysteresis state of %s", key)
+            skipped += 1
+    return windows, skipped
+
+
+class HystStateStore(object):
+    """
+    Base class of the hysteresis state stores.
+    """
+
+    # Import the old per-device pickle files on first load.
+    migrate = True
+    # save() needs every window of a pair, not only the changed ones.
+    fullState = False
+    # Other processes save to the store too: read() only returns the
+    # daemon's own copy, and fetch() what the others saved.
+    shared = False
+
+    def load(self, device, threshold):
+        """Return the hystCount dictionary of a device/threshold pair.
+        State left behind by the old per-device pickle files is moved
+        into this store on first load.
+        """
+        hystCount = self._load(device, threshold)
+        if not hystCount and self.hasLegacy(device, threshold):
+            legacy = PickleFileStore()
+            hystCount = legacy.load(device, threshold)
+            if hystCount:
+                log.info("migrating hysteresis state of %s %s",
+                         device, threshold)
+                self.save([(device, threshold,
+                            dict((key, window.copy())
+                                 for key, window in hystCount.iteritems()),
+                            hystCount.keys())])
+                legacy.delete(device, threshold)
+        return hystCount
+
+    def read(self, device, threshold):
+        """Like load() but without the migration.  It is safe to call
+        while another thread saves.
+        """
+        return self._load(device, threshold)
+
+    def hasLegacy(self, device, threshold):
+        """Whether old pickle files are left for load() to migrate.
+        """
+        return self.migrate and PickleFileStore().exists(device, threshold)
+
+    def _load(self, device, threshold):
+        raise NotImplementedError
+
+    def save(self, records):
+        """Save a sequence of (device, threshold, hystCount, changedKeys)
+        records.  hystCount holds the changed windows, or all windows of
+        the pair when fullState is set.
+        """
+        raise NotImplementedError
+
+    def delete(self, device, threshold):
+        raise NotImplementedError
+
+    def keys(self):
+        """All hystCountKeys held by the store.
+        """
+        raise NotImplementedError
+
+    def deleteKeys(self, keys):
+        """Delete the windows of some hystCountKeys, whatever pair they
+        belong to.  Return how many were deleted and their size.
+        """
+        raise NotImplementedError
+
+    def loadAll(self, threads=1):
+        """Every window of the store keyed by hystCountKey, and the
+        number of unreadable ones that were skipped.
+        """
+        raise NotImplementedError
+
+    def exclusive(self):
+        """Whether the keys the store holds are the daemon's alone, so
+        that compaction may delete those it no longer checks.
+        """
+        return False
+
+    def fetch(self, pairs):
+        """Windows other writers saved to some (device, threshold) pairs
+        that read() did not return, keyed like takeRefreshed().  Only
+        shared stores have any.
+        """
+        return {}
+
+    def takeRefreshed(self):
+        """Windows other writers saved since the last call, as a
+        dictionary of (device, threshold) -> {hystCountKey: window}.
+        """
+        return {}
+
+    def close(self):
+        pass
+
+
+class PickleFileStore(HystStateStore):
+    """
+    Two pickle files per device/threshold pair in $ZENHOME/var, one with
+    a deque per datapoint and one with the flags.  This is the format
+    older versions of the ZenPack used.  The escalation counts of the
+    windows go into the flags file too, as a dictionary under a key no
+    datapoint can have.
+
+    The files of every daemon share the directory, so keys() and
+    deleteKeys() only look at the pairs this process loaded or saved.
+    """
+
+    migrate = False
+    fullState = True
+    escalationKey = 'escalation'
+
+    def __init__(self):
+        self._pairs = set()
+
+    def _path(self, device, threshold, kind):
+        return zenPath('var/%s_%s_%s.pickle' % (device, threshold, kind))
+
+    def exists(self, device, threshold):
+        return any(os.path.exists(self._path(device, threshold, kind))
+                   for kind in ('hystCount', 'hystFlag'))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            log.debug("restored %r", state)
+            return state
+        except Exception:
+            log.debug("error loading %s", path)
+            return {}
+
+    def _load(self, device, threshold):
+        hystCount = self._read(self._path(device, threshold, 'hystCount'))
+        hystFlag = self._read(self._path(device, threshold, 'hystFlag'))
+        escalation = hystFlag.pop(self.escalationKey, {})
+        if hystCount or hystFlag:
+            self._pairs.add((device, threshold))
+        # Datapoints without history (M is 0) only have a flag.
+        empty = deque(maxlen=0)
+        return dict((key, asWindow(hystCount.get(key, empty),
+                                   hystFlag.get(key, 0),
+                                   escalation.get(key)))
+                    for key in set(hystCount) | set(hystFlag))
+
+    def save(self, records):
+        for device, threshold, hystCount, changed in records:
+            self._pairs.add((device, threshold))
+            counts = {}
+            for key, window in hystCount.iteritems():
+                if isinstance(window, HystTimeWindow):
+                    # Older versions have no deque for these.
+                    counts[key] = window
+                elif window.maxlen:
+                    counts[key] = window.toDeque()
+            counts = pickle.dumps(counts)
+            flags = dict((key, window.flag)
+                         for key, window in hystCount.iteritems())
+            escalation = dict((key, window.escalation)
+                              for key, window in hystCount.iteritems()
+                              if window.escalation is not None)
+            if escalation:
+                flags[self.escalationKey] = escalation
+            flags = pickle.dumps(flags)
+            atomicWrite(self._path(device, threshold, 'hystCount'), counts,
+                        raiseException=False)
+            atomicWrite(self._path(device, threshold, 'hystFlag'), flags,
+                        raiseException=False)
+            stats.bytesWritten += len(counts) + len(flags)
+
+    def delete(self, device, threshold):
+        self._pairs.discard((device, threshold))
+        for kind in ('hystCount', 'hystFlag'):
+            try:
+                os.remove(self._path(device, threshold, kind))
+            except OSError:
+                pass
+
+    def _ownPaths(self):
+        return [self._path(device, threshold, kind)
+                for device, threshold in sorted(self._pairs)
+                for kind in ('hystCount', 'hystFlag')]
+
+    def exclusive(self):
+        # Only the pairs of the daemon's own thresholds are looked at.
+        return True
+
+    def keys(self):
+        keys = set()
+        for path in self._ownPaths():
+            keys.update(self._read(path))
+        keys.discard(self.escalationKey)
+        return list(keys)
+
+    def deleteKeys(self, keys):
+        keys = set(keys)
+        deleted, size = set(), 0
+        for path in self._ownPaths():
+            if not os.path.exists(path):
+                continue
+            state = self._read(path)
+            found = keys.intersection(state)
+            if not found:
+                continue
+            deleted.update(found)
+            before = os.path.getsize(path)
+            for key in found:
+                del state[key]
+            escalation = state.get(self.escalationKey)
+            if escalation is not None:
+                for key in found:
+                    escalation.pop(key, None)
+                if not escalation:
+                    del state[self.escalationKey]
+            if state:
+                data = pickle.dumps(state)
+                atomicWrite(path, data, raiseException=False)
+                size += max(before - len(data), 0)
+            else:
+                try:
+                    os.remove(path)
+                    size += before
+                except OSError:
+                    pass
+        return len(deleted), size
+
+    def loadAll(self, threads=1):
+        paths = [zenPath('var', name) for name in os.listdir(zenPath('var'))
+                 if name.endswith(('_hystCount.pickle', '_hystFlag.pickle'))]
+
+        def read(path):
+            try:
+                with open(path, 'rb') as f:
+                    return path, pickle.load(f)
+            except Exception:
+                return path, None
+
+        # The files are many and small: reading them is mostly waiting.
+        pool = ThreadPool(max(threads, 1))
+        try:
+            contents = pool.map(read, paths)
+        finally:
+            pool.close()
+            pool.join()
+        counts, flags, escalation = {}, {}, {}
+        skipped = 0
+        for path, state in contents:
+            if not isinstance(state, dict):
+                log.warn("skipping unreadable hysteresis state %s", path)
+                skipped += 1
+            elif path.endswith('_hystCount.pickle'):
+                counts.update(state)
+            else:
+                escalation.update(state.pop(self.escalationKey, {}))
+                flags.update(state)
+        empty = deque(maxlen=0)
+        windows = {}
+        for key in set(counts) | set(flags):
+            try:
+                windows[key] = asWindow(counts.get(key, empty),
+                                        flags.get(key, 0),
+                                        escalation.get(key))
+            except Exception:
+                skipped += 1
+        return windows, skipped
+
+
+class SqliteStore(HystStateStore):
+    """
+    All hysteresis state of a daemon in one sqlite file, one row per
+    hystCountKey holding the encoded HystWindow.  Loads go through a
+    connection of their own; in WAL mode they don't wait for a save.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = zenPath('var', '%s_hystState.sqlite' % stateName())
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hyst_state ("
+            " key TEXT PRIMARY KEY,"
+            " state BLOB NOT NULL)")
+        self._db.commit()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hyst_meta ("
+            " name TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL)")
+        self._db.commit()
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.text_factory = str
+        self._readLock = threading.Lock()
+        # Every process that has the file open holds a shared lock on
+        # <path>.lock, see exclusive().
+        self._lock = open(path + '.lock', 'a')
+        fcntl.flock(self._lock, fcntl.LOCK_SH)
+        self.exclusive()
+
+    def _load(self, device, threshold):
+        hystCount = {}
+        with self._readLock:
+            rows = self._reader.execute(
+                "SELECT key, state FROM hyst_state"
+                " WHERE key >= ? AND key < ?",
+                keyRange(device, threshold)).fetchall()
+        for key, state in rows:
+            try:
+                hystCount[key] = decode(str(state))
+            except Exception:
+                log.warn("dropping unreadable hysteresis state of %s", key)
+        return hystCount
+
+    def save(self, records):
+        rows = []
+        for device, threshold, hystCount, changed in records:
+            for key in changed:
+                if key in hystCount:
+                    rows.append(
+                        (key, sqlite3.Binary(hystCount[key].encode())))
+        if not rows:
+            return
+        stats.bytesWritten += sum(len(state) for key, state in rows)
+        try:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO hyst_state (key, state)"
+                    " VALUES (?, ?)", rows)
+        except sqlite3.Error:
+            log.exception("unable to save hysteresis state to %s", self.path)
+
+    def delete(self, device, threshold):
+        with self._db:
+            self._db.execute(
+                "DELETE FROM hyst_state WHERE key >= ? AND key < ?",
+                keyRange(device, threshold))
+
+    def keys(self):
+        return [row[0] for row in
+                self._db.execute("SELECT key FROM hyst_state")]
+
+    def deleteKeys(self, keys):
+        keys = list(keys)
+        deleted, size = 0, 0
+        with self._db:
+            # Within sqlite's limit on the parameters of a statement.
+            for start in xrange(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                where = " WHERE key IN (%s)" % ','.join('?' * len(chunk))
+                count, length = self._db.execute(
+                    "SELECT count(*), sum(length(state)) FROM hyst_state" +
+                    where, chunk).fetchone()
+                self._db.execute("DELETE FROM hyst_state" + where, chunk)
+                deleted += count
+                size += length or 0
+        return deleted, size
+
+    def loadAll(self, threads=1):
+        return _decodeAll(
+            self._db.execute("SELECT key, state FROM hyst_state"))
+
+    def exclusive(self):
+        """Whether no other process has had the file open at the same
+        time.  A file found shared stays marked as such, as the other
+        process may come back for its state.
+        """
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            shared = False
+        except IOError:
+            shared = True
+        finally:
+            # A failed conversion may have dropped the shared lock too.
+            fcntl.flock(self._lock, fcntl.LOCK_SH)
+        with self._db:
+            if not shared:
+                return self._db.execute(
+                    "SELECT value FROM hyst_meta WHERE name = 'shared'"
+                ).fetchone() is None
+            if self._db.execute(
+                    "INSERT OR IGNORE INTO hyst_meta (name, value)"
+                    " VALUES ('shared', '1')").rowcount:
+                log.warn("%s is used by another process as well, its"
+                         " hysteresis state is not compacted", self.path)
+        return False
+
+    def close(self):
+        self._reader.close()
+        self._db.close()
+        self._lock.close()
+
+
+class ServiceStore(HystStateStore):
+    """
+    State kept by a service that several collectors share, see
+    HystService.py.  Every change is also saved to the daemon's own
+    sqlite store.  That copy answers loads, so that the reactor thread
+    never waits for the service, and the changes the service missed go
+    out with the next save.  fetch() then reads the pairs from the
+    service in a thread.
+
+    Each hash counts the saves made to it in its _version field.  Before
+    a save the store compares these with the versions it last saw.  A
+    hash another collector saved in between is read again, and its
+    windows this daemon did not change are handed to the state writer
+    through takeRefreshed(), so collectors checking the same device do
+    not keep overwriting each other's history.
+    """
+
+    # Seconds before an unreachable service is tried again.
+    retryInterval = 30
+    # Hash field holding the number of saves made to the hash.
+    versionField = '_version'
+    shared = True
+
+    def __init__(self, url=None, local=None):
+        if url is None:
+            url = os.environ.get('ZENHYST_SERVICE', DEFAULT_URL)
+        self.url = url
+        self.pool = connect(url)
+        self.local = local if local is not None else SqliteStore()
+        # The pairs this daemon saved to the service and the version it
+        # last saw of each, kept with the local copy.
+        with self.local._db:
+            self.local._db.execute(
+                "CREATE TABLE IF NOT EXISTS hyst_service_pair ("
+                " device TEXT NOT NULL,"
+                " threshold TEXT NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " PRIMARY KEY (device, threshold))")
+        self._versions = dict(
+            ((device, threshold), version)
+            for device, threshold, version in self.local._db.execute(
+                "SELECT device, threshold, version FROM hyst_service_pair"))
+        self._saved = set(self._versions)
+        # (device, threshold) -> (windows, changed keys) not sent yet,
+        # guarded by _pendingLock for read()
+        self._pending = {}
+        self._pendingLock = threading.Lock()
+        # The pending changes _send() is sending.
+        self._sending = {}
+        # (device, threshold) -> {hystCountKey: window} saved by others
+        self._refreshed = {}
+        self._retry = 0
+
+    def _hash(self, device, threshold):
+        return 'hyst:%s:%s' % (device, threshold)
+
+    def _execute(self, commands):
+        """Replies to a pipeline of commands, None when the service
+        failed.
+        """
+        if time.time() < self._retry:
+            return None
+        try:
+            return self.pool.execute(commands)
+        except HystServiceError as e:
+            stats.serviceErrors += 1
+            self._retry = time.time() + self.retryInterval
+            log.warn("hysteresis state service %s failed: %s", self.url, e)
+            return None
+
+    def _fields(self, fields):
+        """The version of a hash and its windows from an HGETALL reply.
+        """
+        version, hystCount = 0, {}
+        for key, state in zip(fields[::2], fields[1::2]):
+            if key == self.versionField:
+                version = int(state)
+                continue
+            try:
+                hystCount[key] = decode(state)
+            except Exception:
+                log.warn("dropping unreadable hysteresis state of %s", key)
+        return version, hystCount
+
+    def _load(self, device, threshold):
+        return self.local.read(device, threshold)
+
+    def fetch(self, pairs):
+        """Windows of pairs the service has from other collectors since
+        this daemon last saw them, without those this daemon has not sent
+        yet.  A pair the service does not have gets the local copy with
+        the next save.
+        """
+        pairs = list(pairs)
+        replies = self._execute(
+            [('HGETALL', self._hash(*pair)) for pair in pairs])
+        if replies is None:
+            return {}
+        fetched = {}
+        for pair, fields in zip(pairs, replies):
+            version, hystCount = self._fields(fields)
+            local = None
+            if not hystCount:
+                # State the daemon kept before it used the service.
+                local = self.local.read(*pair)
+            elif version != self._versions.get(pair, 0):
+                self._versions[pair] = version
+                fetched[pair] = hystCount
+            with self._pendingLock:
+                if local:
+                    self._merge(pair, local, set(local))
+                # The changes the service missed are newer than what it has.
+                for pending in (self._sending.get(pair),
+                                self._pending.get(pair)):
+                    if pending is not None:
+                        for key in pending[1]:
+                            hystCount.pop(key, None)
+        return fetched
+
+    def _merge(self, pair, hystCount, changed):
+        """Add changes to those pending, with _pendingLock held.
+        """
+        pending = self._pending.setdefault(pair, ({}, set()))
+        pending[0].update(hystCount)
+        pending[1].update(changed)
+
+    def save(self, records):
+        self.local.save(records)
+        with self._pendingLock:
+            for device, threshold, hystCount, changed in records:
+                self._merge((device, threshold), hystCount, changed)
+        self._send()
+
+    def _send(self):
+        """Send the pending changes as one pipeline, after reading again
+        the hashes other collectors saved since this daemon last did.
+        """
+        with self._pendingLock:
+            pending, self._pending = self._pending, {}
+            self._sending = pending
+        try:
+            self._sendPending(pending)
+        finally:
+            with self._pendingLock:
+                self._sending = {}
+
+    def _sendPending(self, pending):
+        pairs = [pair for pair, (hystCount, changed) in
+                 pending.iteritems() if changed]
+        if not pairs:
+            return
+        names = [self._hash(*pair) for pair in pairs]
+        versions = self._execute(
+            [('HGET', name, self.versionField) for name in names])
+        if versions is None:
+            self._unsent(pending)
+            return
+        versions = [int(version or 0) for version in versions]
+        stale = [i for i, pair in enumerate(pairs)
+                 if versions[i] != self._versions.get(pair, 0)]
+        if stale:
+            replies = self._execute([('HGETALL', names[i]) for i in stale])
+            if replies is None:
+                self._unsent(pending)
+                return
+            for i, fields in zip(stale, replies):
+                version, hystCount = self._fields(fields)
+                # What this daemon changed goes out below.
+                for key in pending[pairs[i]][1]:
+                    hystCount.pop(key, None)
+                self._refreshed.setdefault(pairs[i], {}).update(hystCount)
+        commands, sent = [], []
+        for i, (pair, name) in enumerate(zip(pairs, names)):
+            hystCount, changed = pending[pair]
+            command = ['HSET', name]
+            for key in changed:
+                window = hystCount.get(key)
+                if window is not None:
+                    command.extend((key, window.encode()))
+            if len(command) > 2:
+                commands.append(command)
+                commands.append(('HINCRBY', name, self.versionField, 1))
+                sent.append(i)
+        if not commands:
+            return
+        replies = self._execute(commands)
+        if replies is None:
+            self._unsent(pending)
+            return
+        rows = []
+        for i, version in zip(sent, replies[1::2]):
+            pair, before, version = pairs[i], versions[i], int(version)
+            # A save by another collector right after the versions were
+            # read makes this one's differ, so the next save reads it.
+            if version != before + 1:
+                version -= 1
+            self._versions[pair] = version
+            self._saved.add(pair)
+            rows.append(pair + (version,))
+        try:
+            with self.local._db:
+                self.local._db.executemany(
+                    "INSERT OR REPLACE INTO hyst_service_pair"
+                    " (device, threshold, version) VALUES (?, ?, ?)", rows)
+        except sqlite3.Error:
+            log.exception("unable to save hysteresis state to %s",
+                          self.local.path)
+
+    def _unsent(self, pending):
+        """Put back changes the service did not get, under any made
+        since.
+        """
+        with self._pendingLock:
+            newer, self._pending = self._pending, pending
+            for pair, (hystCount, changed) in newer.iteritems():
+                self._merge(pair, hystCount, changed)
+
+    def takeRefreshed(self):
+        refreshed, self._refreshed = self._refreshed, {}
+        return refreshed
+
+    def delete(self, device, threshold):
+        with self._pendingLock:
+            self._pending.pop((device, threshold), None)
+        self._refreshed.pop((device, threshold), None)
+        self._execute([('DEL', self._hash(device, threshold))])
+        self.local.delete(device, threshold)
+
+    def keys(self):
+        """The keys of this daemon: those of its local copy, not those
+        of every collector sharing the service.
+        """
+        return self.local.keys()
+
+    def deleteKeys(self, keys):
+        """Delete keys from the local copy, and from the hashes this
+        daemon saved that no other collector saved since.  A hash
+        another collector keeps saving is left alone.
+        """
+        keys = set(keys)
+        with self._pendingLock:
+            for hystCount, changed in self._pending.itervalues():
+                changed.difference_update(keys)
+        deleted, size = self.local.deleteKeys(keys)
+        pairs = []
+        for pair in sorted(self._saved):
+            low, high = keyRange(*pair)
+            inRange = [key for key in keys if low <= key < high]
+            if inRange:
+                pairs.append((pair, self._hash(*pair), inRange))
+        if not pairs:
+            return deleted, size
+        versions = self._execute(
+            [('HGET', name, self.versionField) for pair, name, _ in pairs])
+        if versions is None:
+            return deleted, size
+        fields = [(name, key)
+                  for (pair, name, found), version in zip(pairs, versions)
+                  if int(version or 0) == self._versions.get(pair)
+                  for key in found]
+        if not fields:
+            return deleted, size
+        # The length of each field, then the fields themselves.
+        replies = self._execute(
+            [('HSTRLEN', name, key) for name, key in fields] +
+            [('HDEL', name, key) for name, key in fields])
+        if replies is None:
+            return deleted, size
+        # The service holds the same windows as the local copy.
+        return (max(deleted, len(fields)),
+                max(size, sum(replies[:len(fields)])))
+
+    def exclusive(self):
+        # keys() and deleteKeys() go by the local copy.
+        return self.local.exclusive()
+
+    def loadAll(self, threads=1):
+        """The windows of the pairs this daemon saved to the service, not
+        those of every collector sharing it.
+        """
+        self._send()
+        pairs = sorted(self._saved)
+        replies = self._execute(
+            [('HGETALL', self._hash(*pair)) for pair in pairs])
+        if replies is None:
+            return self.local.loadAll(threads)
+        windows, skipped = _decodeAll(
+            (key, state) for fields in replies
+            for key, state in zip(fields[::2], fields[1::2])
+            if key != self.versionField)
+        for pair, fields in zip(pairs, replies):
+            self._versions[pair] = int(dict(
+                zip(fields[::2], fields[1::2])).get(self.versionField, 0))
+        return windows, skipped
+
+    def close(self):
+        self._send()
+        self.pool.close()
+        self.local.close()
+
+
+class JournalStore(HystStateStore):
+    """
+    All hysteresis state of a daemon in an append-only journal next to a
+    snapshot, both in $ZENHOME/var.  A save appends one record per changed
+    datapoint holding its encoded window, flag included, and syncs the
+    journal.  Once the journal grows past ZENHYST_JOURNAL_MB megabytes the
+    whole state is written to a new snapshot and the journal is emptied.
+
+    The state is kept in memory in encoded form and rebuilt from the
+    snapshot and the journal when the store is opened.  A record cut
+    short by a crash fails its checksum; it and anything after it are
+    dropped.
+
+    One process at a time may have the store open: it holds an exclusive
+    lock on the journal, and a second one gets HystStoreLocked.
+    """
+
+    # length of the payload, its crc32, kind
+    RECORD = struct.Struct('!IIB')
+    SET = 1
+    DELETE = 2
+    DELETE_KEY = 3
+
+    def __init__(self, path=None, limit=None):
+        if path is None:
+            path = zenPath('var', '%s_hystState' % stateName())
+        if limit is None:
+            limit = float(os.environ.get('ZENHYST_JOURNAL_MB', 16)) * 2 ** 20
+        self.path = path
+        self.limit = limit
+        # (device, threshold) -> {hystCountKey: encoded window}
+        self._state = {}
+        self._journal = open(path + '.journal', 'ab')
+        try:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._journal.close()
+            log.error("hysteresis state %s.journal is used by another"
+                      " process", path)
+            raise HystStoreLocked("%s.journal is used by another process"
+                                  % path)
+        self._read(path + '.snapshot')
+        size = self._read(path + '.journal')
+        # Drop whatever a crash left after the last whole record.
+        self._journal.truncate(size)
+        self._journal.seek(size)
+
+    def _read(self, path):
+        """Apply the records of a file, return the size of its readable
+        part.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return 0
+        header = self.RECORD
+        pos = 0
+        while pos + header.size <= len(data):
+            length, crc, kind = header.unpack_from(data, pos)
+            start = pos + header.size
+            payload = data[start:start + length]
+            if len(payload) != length or \
+                    zlib.crc32(payload) & 0xffffffff != crc:
+                log.warn("ignoring damaged hysteresis state after byte %d"
+                         " of %s", pos, path)
+                break
+            self._apply(kind, payload)
+            pos = start + length
+        return pos
+
+    def _apply(self, kind, payload):
+        if kind == self.SET:
+            device, threshold, key, state = payload.split('\0', 3)
+            self._state.setdefault((device, threshold), {})[key] = state
+        elif kind == self.DELETE:
+            device, threshold = payload.split('\0', 1)
+            self._state.pop((device, threshold), None)
+        elif kind == self.DELETE_KEY:
+            device, threshold, key = payload.split('\0', 2)
+            pair = self._state.get((device, threshold))
+            if pair is not None:
+                pair.pop(key, None)
+                if not pair:
+                    del self._state[(device, threshold)]
+
+    def _record(self, kind, *fields):
+        payload = '\0'.join(fields)
+        return self.RECORD.pack(len(payload),
+                                zlib.crc32(payload) & 0xffffffff,
+                                kind) + payload
+
+    def _append(self, records):
+        self._journal.write(''.join(records))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        if self._journal.tell() > self.limit:
+            self.snapshot()
+
+    def _load(self, device, threshold):
+        hystCount = {}
+        # A copy, as a save may change the pair meanwhile.
+        pair = self._state.get((device, threshold), {}).items()
+        for key, state in pair:
+            try:
+                hystCount[key] = decode(state)
+            except Exception:
+                log.warn("dropping unreadable hysteresis state of %s", key)
+        return hystCount
+
+    def save(self, records):
+        journal = []
+        for device, threshold, hystCount, changed in records:
+            pair = self._state.setdefault((device, threshold), {})
+            for key in changed:
+                if key in hystCount:
+                    state = pair[key] = hystCount[key].encode()
+                    journal.append(self._record(self.SET, device, threshold,
+                                                key, state))
+        if not journal:
+            return
+        stats.bytesWritten += sum(len(record) for record in journal)
+        try:
+            self._append(journal)
+        except (IOError, OSError):
+            log.exception("unable to save hysteresis state to %s.journal",
+                          self.path)
+
+    def snapshot(self):
+        """Write the whole state to the snapshot and empty the journal.
+        A crash in between leaves records in the journal that the
+        snapshot already holds, which is harmless.
+        """
+        records = [self._record(self.SET, device, threshold, key, state)
+                   for (device, threshold), pair in self._state.iteritems()
+                   for key, state in pair.iteritems()]
+        path = self.path + '.snapshot'
+        # Synced before it replaces the old one, and the rename synced
+        # before the journal is emptied: a crash must not leave an empty
+        # journal next to the old snapshot.
+        with open(path + '.tmp', 'wb') as f:
+            f.write(''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        _syncDirectory(path)
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        log.debug("hysteresis state snapshot of %d datapoints written to"
+                  " %s.snapshot", len(records), self.path)
+
+    def delete(self, device, threshold):
+        if self._state.pop((device, threshold), None) is not None:
+            self._append([self._record(self.DELETE, device, threshold)])
+
+    def keys(self):
+        return [key for pair in self._state.itervalues() for key in pair]
+
+    def deleteKeys(self, keys):
+        keys = set(keys)
+        journal = []
+        size = 0
+        for (device, threshold), pair in self._state.items():
+            for key in keys.intersection(pair):
+                size += len(pair.pop(key))
+                journal.append(self._record(self.DELETE_KEY, device,
+                                            threshold, key))
+            if not pair:
+                del self._state[(device, threshold)]
+        if journal:
+            self._append(journal)
+        return len(journal), size
+
+    def loadAll(self, threads=1):
+        return _decodeAll(item for pair in self._state.itervalues()
+                          for item in pair.iteritems())
+
+    def exclusive(self):
+        # No other process can open the journal.
+        return True
+
+    def close(self):
+        self._journal.close()
+
+
+# Backends that can be selected with ZENHYST_STORE.
+STORES = {
+    'sqlite': SqliteStore,
+    'journal': JournalStore,
+    'pickle': PickleFileStore,
+    'service': ServiceStore,
+}
+
+_store = None
+
+
+def getStore():
+    """The state store of this daemon, created on first use.
+    """
+    global _store
+    if _store is None:
+        kind = os.environ.get('ZENHYST_STORE', 'sqlite')
+        if kind not in STORES:
+            log.error("unknown hysteresis state store %r, using sqlite", kind)
+            kind = 'sqlite'
+        _store = STORES[kind]()
+    return _store
+
+
+def resetStore():
+    """Forget the store without closing it, so that the next
+    getStore() opens it again.
+    """
+    global _store
+    _store = None
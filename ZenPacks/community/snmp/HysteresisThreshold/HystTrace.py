@@ -0,0 +1,58 @@
+__doc__ = """HystTrace
+Tracing of hysteresis decisions.
+
+A trace line is written for every value a threshold checks when the
+zen.HysteresisThreshold logger is at DEBUG, or at INFO for the devices
+listed in ZENHYST_TRACE_DEVICES (comma separated) or added with
+tracer.add().  Nothing about a value is computed unless it is traced.
+"""
+
+import os
+import logging
+
+log = logging.getLogger('zen.HysteresisThreshold')
+traceLog = logging.getLogger('zen.HysteresisThreshold.trace')
+
+
+class HystTracer(object):
+    """
+    Decides which devices get traced and writes the trace lines.
+    """
+
+    def __init__(self, devices=()):
+        self.devices = set(devices)
+
+    def add(self, device):
+        self.devices.add(device)
+
+    def remove(self, device):
+        self.devices.discard(device)
+
+    def level(self, device):
+        """Log level to trace device at, 0 when it is not traced.
+        """
+        if device in self.devices:
+            return logging.INFO
+        if log.isEnabledFor(logging.DEBUG):
+            return logging.DEBUG
+        return 0
+
+    def sample(self, level, instance, dp, hystKey, value, events):
+        window = instance.hystCount.get(hystKey)
+        traceLog.log(
+            level,
+            "device=%s component=%s threshold=%s dp=%s value=%s "
+            "min=%s max=%s N=%s M=%s K=%s bad=%s goodRun=%s flag=%s "
+            "severity=%s",
+            instance.context().deviceName, instance.context().componentName,
+            instance.name(), dp, value, instance.minimum, instance.maximum,
+            instance.badCount, instance.queueSize, instance.goodCount,
+            window.bad if window is not None else 0,
+            window.goodRun if window is not None else 0,
+            window.flag if window is not None else 0,
+            ','.join(str(e.get('severity')) for e in events) or '-')
+
+
+tracer = HystTracer(
+    d.strip() for d in os.environ.get('ZENHYST_TRACE_DEVICES', '').split(',')
+    if d.strip())
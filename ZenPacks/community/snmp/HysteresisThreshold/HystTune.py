@@ -0,0 +1,294 @@
+__doc__ = """HystTune
+Offline replay of a hysteresis threshold, to pick M, N and K.
+
+    zenhysttune --max 80 -M 12,30 -N 7,15 -K 6,20 cpu.csv
+
+reads timestamped values and runs them through the threshold logic for
+every M/N/K combination.  Per combination it prints how many alerts were
+raised, how long it took to raise them, how often the alert state
+flapped and how many alerts a plain min/max threshold would have raised
+on top.  With a single combination the event timeline is printed too,
+on standard error with --json so the JSON stays readable.
+
+The input has one value per line: "timestamp,value" CSV, the output of
+rrdtool fetch ("timestamp: value ...", see --column) or bare values.
+Timestamps are seconds since the epoch.  Blank lines and lines that
+don't parse, such as headers, are skipped; nan, U and empty values count
+as missing.
+
+Values are read in chunks and replayed with HystVector.replay(), so
+memory use doesn't grow with the input.  Combinations run in a pool of
+processes.  Needs NumPy.
+"""
+
+import re
+import sys
+import json
+import time
+import itertools
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from ZenPacks.community.snmp.HysteresisThreshold import HystVector
+from ZenPacks.community.snmp.HysteresisThreshold.HystVector import \
+    replay, badSamples, NONE, NOTICE, VIOLATED, ESCALATED, CLEAR
+
+# Values replayed at once.
+CHUNK = 65536
+
+KINDS = {NOTICE: 'notice', VIOLATED: 'violated', ESCALATED: 'escalated',
+         CLEAR: 'clear'}
+
+_split = re.compile(r'[,;:\s]+').split
+
+
+def _value(text):
+    if text in ('', 'U', 'u'):
+        return float('nan')
+    return float(text)
+
+
+def readSamples(lines, column=1):
+    """(timestamp, value) of every line that holds a value.  Lines with
+    a bare value get their line number as timestamp.
+    """
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        fields = _split(line)
+        try:
+            if len(fields) == 1:
+                sample = (index, _value(fields[0]))
+            else:
+                sample = (float(fields[0]), _value(fields[column]))
+        except (ValueError, IndexError):
+            continue
+        index += 1
+        yield sample
+
+
+def readChunks(path, column=1, size=CHUNK):
+    """Timestamps and values of a file, as arrays of up to size samples.
+    """
+    numpy = HystVector.numpy
+    stream = sys.stdin if path == '-' else open(path)
+    try:
+        samples = readSamples(stream, column)
+        while True:
+            chunk = list(itertools.islice(samples, size))
+            if not chunk:
+                break
+            times, values = zip(*chunk)
+            yield (numpy.array(times, dtype=float),
+                   numpy.array(values, dtype=float))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+class TuneResult(object):
+    """
+    What a threshold with one M/N/K setting did on the input.
+    """
+
+    def __init__(self, queueSize, badCount, goodCount):
+        self.queueSize = queueSize
+        self.badCount = badCount
+        self.goodCount = goodCount
+        self.samples = 0
+        self.missing = 0
+        self.bad = 0
+        self.notices = 0       # notice episodes, bad values under N of M
+        self.alerts = 0        # violations raised
+        self.escalations = 0
+        self.clears = 0        # raised alerts that were cleared
+        self.minmaxAlerts = 0  # alerts a min/max threshold would raise
+        self.alertDelay = 0.0  # sum of the times from first bad value to alert
+        self.maxAlertDelay = 0.0
+
+    @property
+    def flaps(self):
+        """Changes of the alert state, raised or cleared.
+        """
+        return self.alerts + self.clears
+
+    @property
+    def suppressed(self):
+        return max(self.minmaxAlerts - self.alerts, 0)
+
+    @property
+    def meanAlertDelay(self):
+        return self.alertDelay / self.alerts if self.alerts else 0.0
+
+    def asDict(self):
+        result = dict(self.__dict__)
+        result.update(flaps=self.flaps, suppressed=self.suppressed,
+                      meanAlertDelay=self.meanAlertDelay)
+        return result
+
+
+def simulate(path, minimum, maximum, queueSize, badCount, goodCount,
+             severity=4, escalateCount=0, column=1, timeline=None):
+    """Replay the values of a file through a threshold.
+
+    @parameter timeline: called with (timestamp, kind, severity) for
+        every event that differs from the one before it
+    @rtype: TuneResult
+    """
+    numpy = HystVector.numpy
+    result = TuneResult(queueSize, badCount, goodCount)
+    window, count = None, 0
+    lastKind = NONE
+    lastBad = False
+    alerting = False
+    onset = None
+    for times, values in readChunks(path, column):
+        present = ~numpy.isnan(values)
+        bad = badSamples(values[present], minimum, maximum)
+        result.samples += len(values)
+        result.missing += len(values) - len(bad)
+        result.bad += int(bad.sum())
+        if len(bad):
+            previous = numpy.concatenate([[lastBad], bad[:-1]])
+            result.minmaxAlerts += int((bad & ~previous).sum())
+            lastBad = bool(bad[-1])
+
+        replayed = replay(values, minimum, maximum, badCount, queueSize,
+                          goodCount, severity, escalateCount, window, count)
+        window, count = replayed.window, replayed.count
+
+        # Only the events that differ from the one before them matter.
+        events = numpy.flatnonzero(replayed.kinds)
+        kinds = replayed.kinds[events]
+        changed = kinds != numpy.concatenate([[lastKind], kinds[:-1]])
+        if len(kinds):
+            lastKind = kinds[-1]
+        for i in events[changed]:
+            kind = int(replayed.kinds[i])
+            when = float(times[i])
+            if kind == CLEAR:
+                if alerting:
+                    result.clears += 1
+                alerting = False
+                onset = None
+            else:
+                if onset is None:
+                    onset = when
+                if kind == NOTICE:
+                    result.notices += 1
+                elif not alerting:
+                    alerting = True
+                    result.alerts += 1
+                    result.alertDelay += when - onset
+                    result.maxAlertDelay = max(result.maxAlertDelay,
+                                               when - onset)
+                if kind == ESCALATED:
+                    result.escalations += 1
+            if timeline is not None:
+                timeline(when, kind, int(replayed.severities[i]))
+    return result
+
+
+def _simulate(args):
+    path, options, (queueSize, badCount, goodCount) = args
+    return simulate(path, options.min, options.max, queueSize, badCount,
+                    goodCount, options.severity, options.escalate,
+                    options.column)
+
+
+def _numbers(text):
+    return [int(n) for n in text.split(',') if n.strip()]
+
+
+def _time(timestamp):
+    if timestamp > 1e8:
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+    return '%d' % timestamp
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog [options] FILE (- for standard input)')
+    parser.add_option('--min', type='float', help='minimum value')
+    parser.add_option('--max', type='float', help='maximum value')
+    parser.add_option('-M', default='12',
+                      help='history sizes, comma separated (default 12)')
+    parser.add_option('-N', default='7',
+                      help='bad values out of M, comma separated (default 7)')
+    parser.add_option('-K', default='6',
+                      help='good values in a row to clear, comma separated'
+                           ' (default 6)')
+    parser.add_option('--severity', type='int', default=4)
+    parser.add_option('--escalate', type='int', default=0,
+                      help='escalateCount of the threshold')
+    parser.add_option('--column', type='int', default=1,
+                      help='field holding the value (default 1, the one'
+                           ' after the timestamp)')
+    parser.add_option('--processes', type='int',
+                      help='worker processes, default one per CPU')
+    parser.add_option('--timeline', action='store_true',
+                      help='print the events even for several settings')
+    parser.add_option('--json', action='store_true',
+                      help='print the results as JSON, and the events on'
+                           ' standard error')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('one input file is needed')
+    if options.min is None and options.max is None:
+        parser.error('--min or --max is needed')
+    if HystVector.numpy is None:
+        parser.error('NumPy is not installed')
+    path = args[0]
+
+    # N and K larger than M never let the threshold break or clear.
+    grid = [(m, n, k) for m in _numbers(options.M)
+            for n in _numbers(options.N) for k in _numbers(options.K)
+            if n <= m and k <= m]
+    if not grid:
+        parser.error('no setting with N and K up to M')
+    if len(grid) > 1 and path == '-':
+        parser.error('several settings need a file, not standard input')
+
+    if len(grid) == 1 or options.timeline:
+        # Standard output is left to the JSON document.
+        out = sys.stderr if options.json else sys.stdout
+        results = []
+        for setting in grid:
+            if len(grid) > 1:
+                out.write('M=%d N=%d K=%d\n' % setting)
+            results.append(simulate(
+                path, options.min, options.max, *setting,
+                severity=options.severity,
+                escalateCount=options.escalate, column=options.column,
+                timeline=lambda when, kind, severity: out.write(
+                    '%s %-9s severity %d\n' % (_time(when), KINDS[kind],
+                                               severity))))
+    else:
+        pool = Pool(options.processes)
+        try:
+            results = pool.map(_simulate,
+                               [(path, options, setting) for setting in grid])
+        finally:
+            pool.close()
+            pool.join()
+
+    if options.json:
+        json.dump([r.asDict() for r in results], sys.stdout, indent=2,
+                  sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    print '%5s %5s %5s %7s %7s %10s %6s %10s %12s %12s' % (
+        'M', 'N', 'K', 'alerts', 'minmax', 'suppressed', 'flaps', 'notices',
+        'mean delay', 'max delay')
+    for r in results:
+        print '%5d %5d %5d %7d %7d %10d %6d %10d %12.1f %12.1f%s' % (
+            r.queueSize, r.badCount, r.goodCount, r.alerts, r.minmaxAlerts,
+            r.suppressed, r.flaps, r.notices, r.meanAlertDelay,
+            r.maxAlertDelay,
+            '' if r.badCount + r.goodCount > r.queueSize else '  N+K<=M')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+__doc__ = """HystVector
+Replay of the HystThresholdInstance logic over whole arrays of samples.
+
+checkRange() has to look at one sample at a time.  For backfilling the
+state of a new threshold from RRD history, or for trying N/M/K values on
+months of data, replay() computes the same outcome for a whole series
+with NumPy: rolling sums give the bad count of every window, running
+maxima give the runs of good measurements and the broken flag.
+
+NaN values are treated as missing, like None in checkRange().
+NumPy is only needed when this module is used.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import HystWindow
+
+# What checkRange() returns for a sample.
+NONE = 0        # no event: missing value or clear held back by hysteresis
+NOTICE = 1      # bad, but less than N of M: severity 2 event
+VIOLATED = 2    # threshold broken: event with the threshold's severity
+ESCALATED = 3   # threshold broken and escalateCount reached
+CLEAR = 4       # clear event
+
+# Severity of the events raised before the threshold is broken.
+NOTICE_SEVERITY = 2
+CLEAR_SEVERITY = 0
+
+
+class HystReplay(object):
+    """
+    Outcome of a replay: per sample event kind, severity and escalation
+    count, and the state checkRange() would have ended up with.
+    """
+
+    __slots__ = ('kinds', 'severities', 'counts', 'window', 'count')
+
+    def __init__(self, kinds, severities, counts, window, count):
+        self.kinds = kinds
+        self.severities = severities
+        self.counts = counts
+        self.window = window
+        self.count = count
+
+    def transitions(self):
+        """(sample index, kind, severity, escalation count) of every
+        sample that produced an event.
+        """
+        for i in numpy.flatnonzero(self.kinds):
+            yield (int(i), int(self.kinds[i]), int(self.severities[i]),
+                   int(self.counts[i]))
+
+
+def badSamples(values, minimum, maximum):
+    """Boolean array of the values that violate the threshold, using
+    the same rules as checkRange().
+    """
+    if maximum is not None and minimum is not None:
+        if maximum >= minimum:
+            return (values > maximum) | (values < minimum)
+        return (values > maximum) & (values < minimum)
+    elif maximum is not None:
+        return values > maximum
+    elif minimum is not None:
+        return values < minimum
+    return numpy.zeros(len(values), dtype=bool)
+
+
+def _ffill(marks):
+    """Index of the last True in marks at or before every position,
+    -1 where there is none.
+    """
+    return numpy.maximum.accumulate(
+        numpy.where(marks, numpy.arange(len(marks)), -1))
+
+
+def replay(values, minimum, maximum, badCount, queueSize, goodCount,
+           severity=3, escalateCount=0, window=None, count=None,
+           countKey=None):
+    """Run a series of values through the hysteresis logic.
+
+    @parameter values: samples in collection order, NaN for missing ones
+    @parameter window: HystWindow to start from, None for a new datapoint
+    @parameter count: escalation count to start from, that of countKey
+        in the window when None
+    @parameter countKey: component and datapoint whose escalation count
+        the window returned is to hold; the other counts are kept as they
+        are
+    @rtype: HystReplay
+    """
+    if numpy is None:
+        raise ImportError("HystVector needs numpy")
+    if count is None:
+        count = window.escalationOf(countKey) if window is not None else 0
+    values = numpy.asarray(values, dtype=float)
+    total = len(values)
+    present = numpy.flatnonzero(~numpy.isnan(values))
+    bad = badSamples(values[present], minimum, maximum)
+    n = len(bad)
+
+    # Where checkRange() would start: a fresh window keeping the flag when
+    # there is none (or one holding only a flag, or minutes), the window
+    # fitted to M otherwise.
+    flag = window.flag if window is not None else 0
+    if queueSize > 0:
+        if window is None or window.__class__ is not HystWindow or \
+                not window.maxlen:
+            maxlen, history = queueSize, []
+        else:
+            maxlen, history = window.maxlen, list(window)
+            if n:
+                maxlen, history = queueSize, history[-queueSize:]
+    else:
+        maxlen, history = 0, []
+
+    if maxlen:
+        bits = numpy.concatenate(
+            [numpy.array(history, dtype=numpy.int64),
+             bad.astype(numpy.int64)])
+        pos = numpy.arange(len(history), len(bits))
+        sums = numpy.cumsum(bits)
+        start = pos - maxlen
+        badHyst = sums[pos] - numpy.where(
+            start >= 0, sums[numpy.maximum(start, 0)], 0)
+        run = pos - _ffill(bits == 1)[pos]
+        goodHyst = numpy.minimum(
+            numpy.minimum(run, numpy.minimum(pos + 1, maxlen)), goodCount)
+    else:
+        badHyst = goodHyst = numpy.zeros(n, dtype=numpy.int64)
+
+    # The flag goes up on a bad sample with at least N of M bad and down
+    # after K good ones; everything else leaves it alone.
+    setMarks = bad & (badHyst > badCount - 1)
+    clearMarks = ~bad & (goodHyst >= goodCount)
+    last = _ffill(setMarks | clearMarks)
+    flagAfter = numpy.where(last >= 0, setMarks[numpy.maximum(last, 0)],
+                            flag).astype(numpy.int64)
+    flagBefore = numpy.concatenate([[flag], flagAfter[:-1]])
+
+    broken = bad & ((badHyst > badCount - 1) | (flagBefore == 1))
+    clear = ~bad & ((flagBefore == 0) | (goodHyst >= goodCount))
+
+    # Escalation counts broken samples since the last clear event.
+    brokenSums = numpy.cumsum(broken)
+    lastClear = _ffill(clear)
+    base = numpy.where(lastClear >= 0,
+                       brokenSums[numpy.maximum(lastClear, 0)], -count)
+    counts = numpy.where(broken, brokenSums - base, 0)
+    if n:
+        count = int(brokenSums[-1] - base[-1])
+
+    kinds = numpy.zeros(n, dtype=numpy.int8)
+    kinds[bad & ~broken] = NOTICE
+    kinds[broken] = VIOLATED
+    severities = numpy.where(broken, severity, NOTICE_SEVERITY)
+    if escalateCount:
+        escalated = broken & (counts >= escalateCount)
+        kinds[escalated] = ESCALATED
+        severities = numpy.where(escalated, min(severity + 1, 5), severities)
+    else:
+        counts[:] = 0
+    kinds[clear] = CLEAR
+    severities = numpy.where(clear, CLEAR_SEVERITY, severities)
+    severities[kinds == NONE] = 0
+
+    # The state checkRange() leaves behind.
+    if n:
+        flag = int(flagAfter[-1])
+    if maxlen:
+        escalation = window._copyEscalation() if window is not None else None
+        window = HystWindow(maxlen, bits[-maxlen:], flag, escalation)
+    elif window is not None:
+        window = window.copy()
+        window.flag = flag
+    elif broken.any():
+        window = HystWindow(0, flag=flag)
+    if window is not None and countKey is not None:
+        window.setEscalation(countKey, count)
+
+    allKinds = numpy.zeros(total, dtype=numpy.int8)
+    allKinds[present] = kinds
+    allSeverities = numpy.zeros(total, dtype=numpy.int64)
+    allSeverities[present] = severities
+    allCounts = numpy.zeros(total, dtype=numpy.int64)
+    allCounts[present] = counts
+    return HystReplay(allKinds, allSeverities, allCounts, window, count)
+
+
+def backfill(instance, dp, values):
+    """Set the hysteresis state of one datapoint of a HystThresholdInstance
+    from its history, as if every value had gone through checkRange().
+    Only thresholds that count measurements can be backfilled.
+    """
+    if instance.timeWindow:
+        raise ValueError("%s counts minutes, not measurements" %
+                         instance.name())
+    instance.ensureHystState()
+    hystKey = instance.hystCountKey(dp)
+    result = replay(values, instance.minimum, instance.maximum,
+                    instance.badCount, instance.queueSize,
+                    instance.goodCount, instance.severity,
+                    instance.escalateCount,
+                    instance.hystCount.get(hystKey),
+                    countKey=instance.countKey(dp))
+    if result.window is not None:
+        instance.hystCount[hystKey] = result.window
+        instance.saveHystState(dp)
+    return result
@@ -0,0 +1,462 @@
+__doc__ = """HystWindow
+Sliding window of the last M measurements of a datapoint.
+
+The measurements are packed one bit each.  The window keeps a running
+count of bad measurements and the length of the current run of good
+ones, so neither the N-of-M nor the K-in-a-row check has to walk the
+history.  The broken flag and the escalation counts of the datapoint
+travel with its window, so they are saved with it.  The components of a
+device share the window of a datapoint but escalate on their own, so
+the counts are kept by countKey, and only those that are not 0.
+
+encode() turns a window into a short string:
+
+    version, flag   1 byte each
+    maxlen, pos, size, escalations   unsigned 32 bit, network order
+    bits            (maxlen + 7) / 8 bytes, bit i of the ring is
+                    bit i % 8 of byte i / 8
+    escalations     per count, the length of its countKey (unsigned 16
+                    bit) and the count (unsigned 32 bit) in network
+                    order, then the countKey
+
+HystTimeWindow holds the measurements of the last span minutes instead,
+each with its timestamp, and encodes as:
+
+    version, flag   1 byte each
+    span, start, first, lastBad   doubles, network order (lastBad is
+                    NaN when no measurement was bad)
+    size, escalations   unsigned 32 bit, network order
+    times           size doubles, oldest first
+    bads            size bytes, 1 for bad and 0 for good
+    escalations     as above
+
+Windows saved by older versions, without the escalation counts, decode
+with none.
+"""
+
+import sys
+import struct
+from array import array
+from collections import deque
+
+VERSION = 3
+HEADER = struct.Struct('!BBIIII')
+
+TIME_VERSION = 4
+TIME_HEADER = struct.Struct('!BBddddII')
+
+ESCALATION = struct.Struct('!HI')
+
+# The formats of older versions.
+OLD_VERSION = 1
+OLD_HEADER = struct.Struct('!BBIII')
+OLD_TIME_VERSION = 2
+OLD_TIME_HEADER = struct.Struct('!BBddddI')
+
+NaN = float('nan')
+
+
+class _Escalations(object):
+    """
+    Escalation counts of a window, a dictionary of countKey to count or
+    None when they are all 0.
+    """
+
+    __slots__ = ()
+
+    def escalationOf(self, countKey):
+        escalation = self.escalation
+        if escalation is None:
+            return 0
+        return escalation.get(countKey, 0)
+
+    def setEscalation(self, countKey, count):
+        escalation = self.escalation
+        if count:
+            if escalation is None:
+                escalation = self.escalation = {}
+            escalation[countKey] = count
+        elif escalation is not None:
+            escalation.pop(countKey, None)
+            if not escalation:
+                self.escalation = None
+
+    def _copyEscalation(self):
+        if self.escalation is None:
+            return None
+        return dict(self.escalation)
+
+
+def _packEscalation(escalation):
+    """The escalation counts as encode() appends them.
+    """
+    if not escalation:
+        return ''
+    return ''.join(ESCALATION.pack(len(countKey), count) + countKey
+                   for countKey, count in sorted(escalation.iteritems()))
+
+
+def _unpackEscalation(data, offset, number):
+    """Read number escalation counts from data, which they must end.
+    """
+    escalation = {}
+    for i in xrange(number):
+        length, count = ESCALATION.unpack_from(data, offset)
+        offset += ESCALATION.size
+        countKey = data[offset:offset + length]
+        if len(countKey) != length:
+            raise ValueError("invalid hysteresis escalation counts")
+        escalation[intern(countKey)] = count
+        offset += length
+    if offset != len(data):
+        raise ValueError("invalid hysteresis escalation counts")
+    return escalation or None
+
+
+class HystWindow(_Escalations):
+    """
+    Ring buffer of measurements, 1 for bad and 0 for good, one bit each.
+    """
+
+    __slots__ = ('maxlen', 'bits', 'pos', 'size', 'bad', 'goodRun', 'flag',
+                 'escalation')
+
+    def __init__(self, maxlen, values=(), flag=0, escalation=None):
+        self.maxlen = maxlen
+        self.bits = bytearray((maxlen + 7) >> 3)
+        self.pos = 0
+        self.size = 0
+        self.bad = 0
+        self.goodRun = 0
+        self.flag = flag
+        self.escalation = escalation
+        for value in values:
+            self.append(value)
+
+    @classmethod
+    def fromDeque(cls, history, flag=0, escalation=None):
+        """Convert a deque from the state files of older versions.
+        """
+        maxlen = history.maxlen
+        if maxlen is None:
+            maxlen = len(history)
+        return cls(maxlen, history, flag, escalation)
+
+    def toDeque(self):
+        """The window as older versions stored it.
+        """
+        return deque(self, self.maxlen)
+
+    def append(self, bad):
+        if self.maxlen <= 0:
+            return
+        pos = self.pos
+        i = pos >> 3
+        mask = 1 << (pos & 7)
+        bits = self.bits
+        if self.size == self.maxlen:
+            if bits[i] & mask:
+                self.bad -= 1
+        else:
+            self.size += 1
+        if bad:
+            bits[i] |= mask
+            self.bad += 1
+            self.goodRun = 0
+        else:
+            bits[i] &= ~mask & 0xff
+            if self.goodRun < self.size:
+                self.goodRun += 1
+        pos += 1
+        if pos == self.maxlen:
+            pos = 0
+        self.pos = pos
+
+    def resize(self, maxlen):
+        """Change the length of the window, keeping the newest
+        measurements that fit.
+        """
+        values = list(self)[-maxlen:] if maxlen > 0 else []
+        self.__init__(maxlen, values, self.flag, self.escalation)
+
+    def count(self, bad):
+        """Number of bad (or good) measurements, like deque.count().
+        """
+        if bad:
+            return self.bad
+        return self.size - self.bad
+
+    @property
+    def nbytes(self):
+        """Bytes taken by the measurements.
+        """
+        return len(self.bits)
+
+    def copy(self):
+        window = HystWindow(0, flag=self.flag,
+                            escalation=self._copyEscalation())
+        window.maxlen = self.maxlen
+        window.bits = bytearray(self.bits)
+        window.pos = self.pos
+        window.size = self.size
+        window.bad = self.bad
+        window.goodRun = self.goodRun
+        return window
+
+    def encode(self):
+        escalation = self.escalation
+        return HEADER.pack(VERSION, self.flag, self.maxlen, self.pos,
+                           self.size, len(escalation or ())) + \
+            str(self.bits) + _packEscalation(escalation)
+
+    def __reduce__(self):
+        return decode, (self.encode(),)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        bits = self.bits
+        maxlen = self.maxlen
+        for i in xrange(self.pos - self.size, self.pos):
+            i %= maxlen
+            yield (bits[i >> 3] >> (i & 7)) & 1
+
+    def __repr__(self):
+        return 'HystWindow(%d, %r, flag=%d, escalation=%r)' % (
+            self.maxlen, list(self), self.flag, self.escalation)
+
+
+class HystTimeWindow(_Escalations):
+    """
+    Ring buffer of timestamped measurements, 1 for bad and 0 for good.
+
+    A measurement stands for the time from the one before it up to its
+    own timestamp, so a missed poll is covered by the next measurement.
+    bad is the bad time inside the last span time units and goodRun the
+    time since the last bad measurement (capped at span), both as of the
+    newest measurement.  Measurements whose time lies wholly before the
+    span are dropped as new ones come in; the ring grows when the
+    measurements of a span don't fit.
+    """
+
+    __slots__ = ('span', 'times', 'bads', 'head', 'size', 'start', 'first',
+                 'lastBad', 'total', 'bad', 'goodRun', 'flag', 'escalation')
+
+    def __init__(self, span, flag=0, escalation=None):
+        self.span = span
+        self.times = array('d', [0.0]) * 8
+        self.bads = bytearray(8)
+        self.head = 0
+        self.size = 0
+        # Timestamp of the measurement before the oldest one held.
+        self.start = None
+        # Timestamp of the first measurement ever seen.
+        self.first = None
+        self.lastBad = None
+        # Bad time of the measurements held, the oldest one unclipped.
+        self.total = 0.0
+        self.bad = 0.0
+        self.goodRun = 0.0
+        self.flag = flag
+        self.escalation = escalation
+
+    @property
+    def last(self):
+        """Timestamp of the newest measurement.
+        """
+        if self.size:
+            return self.times[(self.head + self.size - 1) % len(self.times)]
+        return self.start
+
+    def append(self, bad, when):
+        last = self.last
+        if last is None:
+            # Nothing before the first measurement: it stands for no time.
+            self.start = self.first = last = when
+        elif when < last:
+            # The clock went back; keep the timestamps in order.
+            when = last
+        if self.size == len(self.times):
+            self._grow()
+        times = self.times
+        i = (self.head + self.size) % len(times)
+        times[i] = when
+        self.bads[i] = 1 if bad else 0
+        self.size += 1
+        if bad:
+            self.total += when - last
+            self.lastBad = when
+        self._expire(when)
+
+    def _ordered(self):
+        """Timestamps and bad flags of the measurements, oldest first.
+        """
+        head = self.head
+        wrapped = max(head + self.size - len(self.times), 0)
+        end = head + self.size - wrapped
+        return (self.times[head:end] + self.times[:wrapped],
+                self.bads[head:end] + self.bads[:wrapped])
+
+    def _grow(self):
+        times, bads = self._ordered()
+        self.times = times + array('d', [0.0]) * len(times)
+        self.bads = bads + bytearray(len(bads))
+        self.head = 0
+
+    def _expire(self, when):
+        """Drop the measurements that ended before the span, then work
+        out bad and goodRun as of when.
+        """
+        edge = when - self.span
+        times = self.times
+        bads = self.bads
+        capacity = len(times)
+        while self.size and times[self.head] <= edge:
+            head = self.head
+            if bads[head]:
+                self.total -= times[head] - self.start
+            self.start = times[head]
+            self.head = (head + 1) % capacity
+            self.size -= 1
+        if not self.size:
+            self.total = 0.0
+        bad = self.total
+        if self.size and bads[self.head] and self.start < edge:
+            # Only part of the oldest measurement lies inside the span.
+            bad -= edge - self.start
+        self.bad = max(bad, 0.0)
+        since = self.lastBad if self.lastBad is not None else self.first
+        self.goodRun = min(when - since, self.span) if self.size else 0.0
+
+    def count(self, bad):
+        """Number of bad (or good) measurements held.
+        """
+        bads = sum(1 for b in self if b)
+        if bad:
+            return bads
+        return self.size - bads
+
+    @property
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + len(self.bads)
+
+    def copy(self):
+        window = HystTimeWindow(self.span, flag=self.flag,
+                                escalation=self._copyEscalation())
+        window.times = array('d', self.times)
+        window.bads = bytearray(self.bads)
+        for name in ('head', 'size', 'start', 'first', 'lastBad', 'total',
+                     'bad', 'goodRun'):
+            setattr(window, name, getattr(self, name))
+        return window
+
+    def encode(self):
+        times, bads = self._ordered()
+        if sys.byteorder == 'little':
+            times.byteswap()
+        escalation = self.escalation
+        return TIME_HEADER.pack(
+            TIME_VERSION, self.flag, self.span,
+            NaN if self.start is None else self.start,
+            NaN if self.first is None else self.first,
+            NaN if self.lastBad is None else self.lastBad,
+            self.size, len(escalation or ())) + times.tostring() + \
+            str(bads) + _packEscalation(escalation)
+
+    def __reduce__(self):
+        return decode, (self.encode(),)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        bads = self.bads
+        capacity = len(bads)
+        for i in xrange(self.head, self.head + self.size):
+            yield bads[i % capacity]
+
+    def __repr__(self):
+        times, bads = self._ordered()
+        return 'HystTimeWindow(%r, %r, flag=%d, escalation=%r)' % (
+            self.span, zip(times, bads), self.flag, self.escalation)
+
+
+def _decodeTime(data):
+    if data[:1] == chr(OLD_TIME_VERSION):
+        version, flag, span, start, first, lastBad, size = \
+            OLD_TIME_HEADER.unpack_from(data)
+        escalation = None
+        body = data[OLD_TIME_HEADER.size:]
+    else:
+        version, flag, span, start, first, lastBad, size, number = \
+            TIME_HEADER.unpack_from(data)
+        body = data[TIME_HEADER.size:TIME_HEADER.size + size * 9]
+        escalation = _unpackEscalation(data, TIME_HEADER.size + len(body),
+                                       number)
+    if len(body) != size * 9:
+        raise ValueError("invalid hysteresis time window")
+    times = array('d')
+    times.fromstring(body[:size * 8])
+    if sys.byteorder == 'little':
+        times.byteswap()
+    window = HystTimeWindow(span, flag=flag, escalation=escalation)
+    if size:
+        capacity = max(8, 1 << (size - 1).bit_length())
+        window.times = times + array('d', [0.0]) * (capacity - size)
+        window.bads = bytearray(body[size * 8:]) + \
+            bytearray(capacity - size)
+        window.size = size
+    # NaN marks a missing timestamp.
+    window.start = start if start == start else None
+    window.first = first if first == first else None
+    window.lastBad = lastBad if lastBad == lastBad else None
+    previous = window.start
+    for i in xrange(size):
+        if window.bads[i]:
+            window.total += window.times[i] - previous
+        previous = window.times[i]
+    if size:
+        window._expire(window.last)
+    return window
+
+
+def decode(data):
+    """Rebuild a window from the output of HystWindow.encode() or
+    HystTimeWindow.encode().
+    """
+    if data[:1] in (chr(TIME_VERSION), chr(OLD_TIME_VERSION)):
+        return _decodeTime(data)
+    if data[:1] == chr(OLD_VERSION):
+        version, flag, maxlen, pos, size = OLD_HEADER.unpack_from(data)
+        escalation = None
+        bits = bytearray(data[OLD_HEADER.size:])
+    else:
+        version, flag, maxlen, pos, size, number = HEADER.unpack_from(data)
+        end = HEADER.size + ((maxlen + 7) >> 3)
+        bits = bytearray(data[HEADER.size:end])
+        escalation = _unpackEscalation(data, end, number)
+    if version not in (VERSION, OLD_VERSION) or \
+            len(bits) != (maxlen + 7) >> 3 or \
+            size > maxlen or pos >= max(maxlen, 1):
+        raise ValueError("invalid hysteresis window")
+    window = HystWindow(0, flag=flag, escalation=escalation)
+    window.maxlen = maxlen
+    window.bits = bits
+    window.pos = pos
+    window.size = size
+    for bad in window:
+        if bad:
+            window.bad += 1
+            window.goodRun = 0
+        else:
+            window.goodRun += 1
+    return window
+
+
+def asWindow(history, flag=0, escalation=None):
+    """Return history as a HystWindow, converting old deques.
+    """
+    if isinstance(history, deque):
+        return HystWindow.fromDeque(history, flag, escalation)
+    return history
@@ -8,15 +8,10 @@
 # (these info adapter classes) used to create info objects for them are managed
 # in the configure.zcml file.
 
-from zope.component import adapts
 from zope.interface import implements
 
 from Products.Zuul.infos import ProxyProperty
-from Products.Zuul.infos.component import ComponentInfo
-from Products.Zuul.infos.template import RRDDataSourceInfo
 from Products.Zuul.infos.template import ThresholdInfo
-from Products.Zuul.interfaces import template as templateInterfaces
-from Products.Zuul.decorators import info
 from ZenPacks.community.snmp.HysteresisThreshold import interfaces
 
 
@@ -28,3 +23,4 @@ class HystThresholdInfo(ThresholdInfo):
     goodCount = ProxyProperty("goodCount")
     queueSize = ProxyProperty("queueSize")
     escalateCount = ProxyProperty("escalateCount")
+    timeWindow = ProxyProperty("timeWindow")
@@ -1,8 +1,4 @@
 from Products.Zuul.form import schema
-from Products.Zuul.interfaces.component import IComponentInfo
-from Products.Zuul.interfaces.template import IRRDDataSourceInfo
-
-from Products.Zuul.interfaces import IInfo, IFacade
 from Products.Zuul.interfaces.template import IThresholdInfo
 
 
@@ -47,3 +43,6 @@ class IHystThresholdInfo(IThresholdInfo):
     queueSize = schema.TextLine(
         title=u'Measurement Queue Size', order=14, default=u"1")
     escalateCount = schema.Int(title=_t(u'Escalate Count'), order=11)
+    timeWindow = schema.Bool(
+        title=u'Count M, N and K in minutes instead of measurements',
+        order=15)
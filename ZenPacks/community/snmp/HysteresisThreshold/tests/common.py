@@ -0,0 +1,56 @@
+__doc__ = """common
+What the tests of threshold instances share: a stand-in for the
+ThresholdContext of a device or component, and a test case that keeps
+the hysteresis state of the process in a store of its own.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    registry, stateWriter
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import SqliteStore
+
+
+class Context(object):
+    """The parts of a ThresholdContext the instance uses.
+    """
+
+    rrdPath = ''
+
+    def __init__(self, deviceName, componentName=''):
+        self.deviceName = deviceName
+        self.componentName = componentName
+
+    def key(self):
+        return self.deviceName, self.componentName
+
+
+class StateTestCase(unittest.TestCase):
+    """Saves the state of the instances it makes in a temporary sqlite
+    store, flushed by hand.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.useReactor = stateWriter.useReactor
+        stateWriter.useReactor = False
+        registry.reset()
+        stateWriter.reset()
+        stateWriter._store = SqliteStore(
+            os.path.join(self.dir, 'test_hystState.sqlite'))
+
+    def tearDown(self):
+        registry.clear()
+        stateWriter.store.close()
+        registry.reset()
+        stateWriter.reset()
+        stateWriter.useReactor = self.useReactor
+        shutil.rmtree(self.dir)
+
+    def restart(self):
+        """Save and forget the state, as a daemon does when it stops.
+        """
+        registry.clear()
@@ -0,0 +1,87 @@
+__doc__ = """testCompaction
+Deletion of the state of datapoints no threshold instance checks any
+more, and the stores it leaves alone.
+"""
+
+import gc
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold import HystStore
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    registry, stateWriter
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import SqliteStore
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestCompaction(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.ttl = registry.ttl
+        registry.ttl = 60
+
+    def tearDown(self):
+        registry.ttl = self.ttl
+        StateTestCase.tearDown(self)
+
+    def instance(self, dpNames):
+        return HystThresholdInstance('thr', Context('dev'), list(dpNames),
+                                     None, 10, 2, 4, 2, '/Perf', 3, 0)
+
+    def removeDatapoint(self):
+        """Check a and b, then go on with an instance that only has a,
+        as after a config push.
+        """
+        instance = self.instance('ab')
+        for dp in 'ab':
+            instance.checkRange(dp, 20)
+        self.restart()
+        del instance
+        gc.collect()
+        return self.instance('a')
+
+    def stored(self):
+        return sorted(stateWriter.store.keys())
+
+    def testOrphanDeletedAfterTTL(self):
+        instance = self.removeDatapoint()
+        registry.compact(1000)
+        self.assertEqual(self.stored(), ['dev:thr:a', 'dev:thr:b'])
+        registry.compact(1060)
+        self.assertEqual(self.stored(), ['dev:thr:a', 'dev:thr:b'])
+        registry.compact(1061)
+        self.assertEqual(self.stored(), ['dev:thr:a'])
+        self.assertEqual(list(instance.hystCount['dev:thr:a']), [1])
+
+    def testSharedFileLeftAlone(self):
+        instance = self.removeDatapoint()
+        path = stateWriter.store.path
+        # Another daemon of the same name opens the file.
+        SqliteStore(path).close()
+        self.assertFalse(stateWriter.store.exclusive())
+        registry.compact(1000)
+        registry.compact(2000)
+        self.assertEqual(self.stored(), ['dev:thr:a', 'dev:thr:b'])
+        # Also once the other daemon is gone.
+        stateWriter.store.close()
+        stateWriter._store = SqliteStore(path)
+        self.assertFalse(stateWriter.store.exclusive())
+        self.assertEqual(list(instance.hystCount['dev:thr:a']), [1])
+
+    def testMonitorNamesFiles(self):
+        monitor = HystStore.MONITOR
+        try:
+            HystStore.MONITOR = ''
+            self.assertEqual(HystStore.stateName(), HystStore.daemonName())
+            HystStore.MONITOR = 'remote1'
+            self.assertEqual(HystStore.stateName(),
+                             HystStore.daemonName() + '-remote1')
+        finally:
+            HystStore.MONITOR = monitor
+
+
+def test_suite():
+    return unittest.makeSuite(TestCompaction)
@@ -0,0 +1,116 @@
+__doc__ = """testEscalation
+Escalation counts of the components of a device, which share the
+hysteresis window of a datapoint.
+"""
+
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystWindow, HystTimeWindow, decode
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestEscalation(StateTestCase):
+
+    def instance(self, component, M=1, N=1, timeWindow=False):
+        # Any value above 10 violates the threshold at once.
+        return HystThresholdInstance('thr', Context('dev', component), ['dp'],
+                                     None, 10, N, M, 1, '/Perf', 3, 3,
+                                     timeWindow)
+
+    def escalate(self):
+        """Leave eth0 escalated and eth1 violated once.
+        """
+        eth0 = self.instance('eth0')
+        for value in (20, 20, 20):
+            eth0.checkRange('dp', value)
+        self.instance('eth1').checkRange('dp', 20)
+
+    def assertCounts(self, eth0, eth1):
+        # N is out of reach: the counts only go on while the flag stays up.
+        events = eth0.checkRange('dp', 20)
+        self.assertEqual(events[0]['escalation_count'], 4)
+        self.assertEqual(events[0]['severity'], 4)
+        events = eth1.checkRange('dp', 20)
+        self.assertEqual(events[0]['escalation_count'], 2)
+        self.assertEqual(events[0]['severity'], 3)
+
+    def testComponentsCountApart(self):
+        eth0 = self.instance('eth0')
+        eth1 = self.instance('eth1')
+        self.assertEqual(eth0.hystCountKey('dp'), eth1.hystCountKey('dp'))
+        eth0.checkRange('dp', 20)
+        eth0.checkRange('dp', 20)
+        self.assertEqual(eth0.getCount('dp'), 2)
+
+        events = eth1.checkRange('dp', 20)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['escalation_count'], 1)
+        self.assertEqual(events[0]['severity'], 3)
+        self.assertEqual(eth0.getCount('dp'), 2)
+
+        # The third violation of eth0 escalates, eth1 does not follow.
+        events = eth0.checkRange('dp', 20)
+        self.assertEqual(events[0]['escalation_count'], 3)
+        self.assertEqual(events[0]['severity'], 4)
+        self.assertEqual(eth1.getCount('dp'), 1)
+
+        # A clear of one component leaves the count of the other.
+        eth1.checkRange('dp', 0)
+        self.assertEqual(eth1.getCount('dp'), 0)
+        self.assertEqual(eth0.getCount('dp'), 3)
+
+    def testCountsSaved(self):
+        eth0 = self.instance('eth0')
+        eth1 = self.instance('eth1')
+        for value in (20, 20, 20):
+            eth0.checkRange('dp', value)
+        eth1.checkRange('dp', 20)
+        self.restart()
+
+        eth0 = self.instance('eth0')
+        eth1 = self.instance('eth1')
+        self.assertEqual(eth0.getCount('dp'), 3)
+        self.assertEqual(eth1.getCount('dp'), 1)
+        events = eth1.checkRange('dp', 20)
+        self.assertEqual(events[0]['escalation_count'], 2)
+        self.assertEqual(events[0]['severity'], 3)
+
+    def testResized(self):
+        self.escalate()
+        self.assertCounts(self.instance('eth0', M=4, N=3),
+                          self.instance('eth1', M=4, N=3))
+
+    def testFromFlagOnly(self):
+        # M was 0, so the window only held the flag and the counts.
+        eth0 = self.instance('eth0', M=0, N=0)
+        for value in (20, 20, 20):
+            eth0.checkRange('dp', value)
+        self.instance('eth1', M=0, N=0).checkRange('dp', 20)
+        self.assertCounts(self.instance('eth0', M=4, N=3),
+                          self.instance('eth1', M=4, N=3))
+
+    def testSwitchedToMinutes(self):
+        self.escalate()
+        self.assertCounts(self.instance('eth0', M=10, N=5, timeWindow=True),
+                          self.instance('eth1', M=10, N=5, timeWindow=True))
+
+    def testEncoding(self):
+        for window in (HystWindow(8, [1, 0, 1], 1), HystTimeWindow(8)):
+            window.setEscalation('dev:eth0:dp', 7)
+            window.setEscalation('dev:eth1:dp', 1)
+            decoded = decode(window.encode())
+            self.assertEqual(decoded.escalationOf('dev:eth0:dp'), 7)
+            self.assertEqual(decoded.escalationOf('dev:eth1:dp'), 1)
+            self.assertEqual(decoded.escalationOf('dev:eth2:dp'), 0)
+            decoded.setEscalation('dev:eth0:dp', 0)
+            decoded.setEscalation('dev:eth1:dp', 0)
+            self.assertEqual(decoded.escalation, None)
+            self.assertEqual(decode(decoded.encode()).escalation, None)
+
+
+def test_suite():
+    return unittest.makeSuite(TestEscalation)
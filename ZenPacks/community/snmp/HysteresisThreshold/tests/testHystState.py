@@ -0,0 +1,142 @@
+__doc__ = """testHystState
+The state entries the threshold instances of a device share, their
+eviction, and the writer saving them.
+"""
+
+import time
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    registry, stateWriter
+from ZenPacks.community.snmp.HysteresisThreshold.HystStats import stats
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestHystState(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.limits = registry.ttl, registry.budget
+        stats.reset()
+
+    def tearDown(self):
+        registry.ttl, registry.budget = self.limits
+        StateTestCase.tearDown(self)
+
+    def instance(self, device='dev', component=''):
+        return HystThresholdInstance('thr', Context(device, component),
+                                     ['dp'], None, 10, 2, 4, 2, '/Perf', 3, 0)
+
+    def history(self, instance):
+        return list(instance.hystCount[instance.hystCountKey('dp')])
+
+    def testInstancesShareEntry(self):
+        eth0 = self.instance(component='eth0')
+        eth1 = self.instance(component='eth1')
+        eth0.checkRange('dp', 20)
+        eth1.checkRange('dp', 5)
+        self.assertTrue(eth0.hystCount is eth1.hystCount)
+        self.assertEqual(self.history(eth0), [1, 0])
+        # A config push makes new instances, which find the entry.
+        self.assertEqual(self.history(self.instance(component='eth0')),
+                         [1, 0])
+        self.assertEqual(len(registry), 1)
+        self.assertEqual((stats.loads, stats.reattached), (1, 2))
+
+    def testIdleEvicted(self):
+        registry.ttl = 60
+        instance = self.instance()
+        instance.checkRange('dp', 20)
+        entry = registry.attach('dev', 'thr')
+        registry.sweep(entry.used + 30)
+        self.assertTrue(('dev', 'thr') in registry)
+        registry.sweep(entry.used + 61)
+        self.assertFalse(('dev', 'thr') in registry)
+        self.assertEqual(stats.evicted, 1)
+        # Saved with the next flush, and read back by the next check.
+        stateWriter.flush()
+        self.assertEqual(stateWriter.store.keys(), ['dev:thr:dp'])
+        instance.checkRange('dp', 20)
+        self.assertEqual(self.history(instance), [1, 1])
+        self.assertEqual(stats.loads, 2)
+
+    def testEvictedBeforeSave(self):
+        instance = self.instance()
+        instance.checkRange('dp', 20)
+        registry.evict(('dev', 'thr'))
+        # The changes wait for the flush, but a load sees them already.
+        self.assertEqual(stateWriter.store.keys(), [])
+        instance.checkRange('dp', 20)
+        self.assertEqual(self.history(instance), [1, 1])
+
+    def testLeastRecentlyUsedEvicted(self):
+        now = time.time()
+        instances = [self.instance('dev%d' % i) for i in range(4)]
+        for i, instance in enumerate(instances):
+            instance.checkRange('dp', 20)
+            registry.attach('dev%d' % i, 'thr').used = now + i
+        instances[0].checkRange('dp', 20)
+        entry = registry.attach('dev0', 'thr')
+        entry.used = now + 10
+        registry.budget = 2 * entry.size()
+        registry.sweep(now + 20)
+        self.assertEqual(sorted(key for key in registry._entries),
+                         [('dev0', 'thr'), ('dev3', 'thr')])
+        registry.budget = 0
+        registry.sweep(now + 20)
+        self.assertEqual(len(registry), 2)
+
+    def testFlushSavesChangedOnly(self):
+        instances = [self.instance('dev%d' % i) for i in range(3)]
+        for instance in instances:
+            instance.checkRange('dp', 20)
+        stateWriter.flush()
+        self.assertEqual(stats.rowsSaved, 3)
+        instances[1].checkRange('dp', 5)
+        stateWriter.flush()
+        self.assertEqual((stats.saves, stats.rowsSaved), (2, 4))
+        stateWriter.flush()
+        self.assertEqual(stats.saves, 2)
+
+    def testPreload(self):
+        for device in ('dev0', 'dev1', 'dev2'):
+            self.instance(device).checkRange('dp', 20)
+        self.restart()
+        stats.reset()
+        # Attached before the preload: the state in memory is newer.
+        self.instance('dev1').checkRange('dp', 5)
+        registry.preload()
+        self.assertEqual(stats.preloaded, 2)
+        self.assertEqual(self.history(self.instance('dev0')), [1])
+        self.assertEqual(self.history(self.instance('dev1')), [1, 0])
+        self.assertEqual(stats.loads, 1)
+        # State nobody attaches to is dropped after the TTL.
+        registry.sweep(time.time() + registry.ttl + 1)
+        self.assertEqual(registry._takePreloaded('dev2', 'thr'), None)
+
+    def testPreloadUnreadable(self):
+        self.instance().checkRange('dp', 20)
+        self.restart()
+        with stateWriter.store._db:
+            stateWriter.store._db.execute(
+                "INSERT INTO hyst_state (key, state) VALUES (?, ?)",
+                ('dev:thr:bad', 'garbage'))
+        registry.preload()
+        self.assertEqual((stats.preloaded, stats.unreadable), (1, 1))
+        self.assertEqual(self.history(self.instance()), [1])
+
+    def testPreloadInBackground(self):
+        self.instance().checkRange('dp', 20)
+        self.restart()
+        stats.reset()
+        registry.preloadInBackground()
+        registry.waitForPreload()
+        self.assertEqual(self.history(self.instance()), [1])
+        self.assertEqual((stats.preloaded, stats.loads), (1, 0))
+
+
+def test_suite():
+    return unittest.makeSuite(TestHystState)
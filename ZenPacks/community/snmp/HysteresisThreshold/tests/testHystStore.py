@@ -0,0 +1,149 @@
+__doc__ = """testHystStore
+Hysteresis state kept across a restart by every store, and the pickle
+files of older versions.
+"""
+
+import os
+import unittest
+import cPickle as pickle
+from collections import deque
+
+from ZenPacks.community.snmp.HysteresisThreshold import HystStore
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    stateWriter
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import \
+    JournalStore, PickleFileStore, ServiceStore, SqliteStore
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystWindow, HystTimeWindow
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestHystStore(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        # The pickle files go to $ZENHOME/var.
+        os.mkdir(os.path.join(self.dir, 'var'))
+        self.zenPath = HystStore.zenPath
+        HystStore.zenPath = lambda *parts: os.path.join(self.dir, *parts)
+
+    def tearDown(self):
+        HystStore.zenPath = self.zenPath
+        StateTestCase.tearDown(self)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def open(self, kind):
+        if kind == 'sqlite':
+            return SqliteStore(self.path('test.sqlite'))
+        elif kind == 'journal':
+            return JournalStore(self.path('test'))
+        elif kind == 'pickle':
+            return PickleFileStore()
+        return ServiceStore('file://' + self.path('service.db'),
+                            SqliteStore(self.path('local.sqlite')))
+
+    def use(self, kind):
+        stateWriter.store.close()
+        stateWriter._store = self.open(kind)
+
+    def instances(self):
+        return [HystThresholdInstance('thr', Context('dev', component),
+                                      ['a', 'b'], None, 10, 2, 4, 2, '/Perf',
+                                      3, 2, timeWindow)
+                for component, timeWindow in (('eth0', False),
+                                              ('eth1', False),
+                                              ('', True))]
+
+    def state(self, instances):
+        state = []
+        for instance in instances:
+            for dp in instance.dataPointNames:
+                window = instance.hystCount.get(instance.hystCountKey(dp))
+                state.append((instance.getCount(dp), window.flag,
+                              window.__class__, list(window)))
+        return state
+
+    def assertKeepsState(self, kind):
+        self.use(kind)
+        instances = self.instances()
+        for value in (20, 20, 5, 20, 20, 20, 5):
+            for instance in instances:
+                instance.checkRange('a', value)
+                instance.checkRange('b', 25 - value)
+            instances[0].checkRange('a', 20)
+        expected = self.state(instances)
+        self.restart()
+        self.use(kind)
+        self.assertEqual(self.state(self.instances()), expected)
+
+    def testSqlite(self):
+        self.assertKeepsState('sqlite')
+
+    def testJournal(self):
+        self.assertKeepsState('journal')
+
+    def testPickle(self):
+        self.assertKeepsState('pickle')
+
+    def testService(self):
+        self.assertKeepsState('service')
+
+    def testDelete(self):
+        for kind in ('sqlite', 'journal', 'pickle'):
+            store = self.open(kind)
+            store.save([('dev', 'thr', {'dev:thr:a': HystWindow(4, [1])},
+                         ['dev:thr:a']),
+                        ('dev2', 'thr', {'dev2:thr:a': HystWindow(4, [0])},
+                         ['dev2:thr:a'])])
+            store.delete('dev', 'thr')
+            self.assertEqual(store.load('dev', 'thr'), {})
+            self.assertEqual(sorted(store.keys()), ['dev2:thr:a'])
+            store.close()
+
+    def writeOldPickles(self):
+        """State files as older versions of the ZenPack left them.
+        """
+        with open(self.path('var/dev_thr_hystCount.pickle'), 'wb') as f:
+            pickle.dump({'dev:thr:a': deque([1, 0, 1], 4),
+                         'dev:thr:b': deque([0], 4)}, f)
+        with open(self.path('var/dev_thr_hystFlag.pickle'), 'wb') as f:
+            pickle.dump({'dev:thr:a': 1, 'dev:thr:b': 0}, f)
+
+    def testOldPickles(self):
+        self.writeOldPickles()
+        hystCount = PickleFileStore().load('dev', 'thr')
+        self.assertEqual(list(hystCount['dev:thr:a']), [1, 0, 1])
+        self.assertEqual(hystCount['dev:thr:a'].flag, 1)
+        self.assertEqual(hystCount['dev:thr:b'].maxlen, 4)
+
+    def testPickleMigration(self):
+        self.writeOldPickles()
+        instance = HystThresholdInstance('thr', Context('dev'), ['a', 'b'],
+                                         None, 10, 2, 4, 2, '/Perf', 3, 0)
+        self.assertEqual(instance.getHystFlag('a'), 1)
+        self.assertEqual(list(instance.hystCount['dev:thr:a']), [1, 0, 1])
+        self.assertEqual(os.listdir(self.path('var')), [])
+        self.assertEqual(sorted(stateWriter.store.keys()),
+                         ['dev:thr:a', 'dev:thr:b'])
+
+    def testPickleEscalation(self):
+        store = PickleFileStore()
+        window = HystTimeWindow(10, flag=1)
+        window.append(1, 100)
+        window.setEscalation('dev:eth0:a', 3)
+        store.save([('dev', 'thr', {'dev:thr:a': window,
+                                    'dev:thr:b': HystWindow(0, flag=1)},
+                     ['dev:thr:a', 'dev:thr:b'])])
+        hystCount = PickleFileStore().load('dev', 'thr')
+        self.assertEqual(hystCount['dev:thr:a'].escalationOf('dev:eth0:a'),
+                         3)
+        self.assertEqual(hystCount['dev:thr:b'].flag, 1)
+
+
+def test_suite():
+    return unittest.makeSuite(TestHystStore)
@@ -0,0 +1,331 @@
+__doc__ = """testHystThreshold
+Checks of HystThresholdInstance and the state it keeps, the lines it
+draws on graphs, and the expressions of HystThreshold behind its limits.
+"""
+
+import random
+import unittest
+import cPickle as pickle
+from collections import deque
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystStats import stats
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds import \
+    HystThreshold
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestHystThreshold(StateTestCase):
+
+    def instance(self, M=4, N=2, K=2, escalateCount=3, component='',
+                 device='dev', dpNames=('dp',), timeWindow=False):
+        return HystThresholdInstance('thr', Context(device, component),
+                                     list(dpNames), None, 10, N, M, K,
+                                     '/Perf', 3, escalateCount, timeWindow)
+
+    def testStateBeforeFirstCheck(self):
+        instance = self.instance()
+        self.assertEqual(instance.hystCount, {})
+        self.assertEqual(instance.hystFlag, {})
+        self.assertEqual(instance.count, {})
+        for value in (20, 20, 20):
+            instance.checkRange('dp', value)
+        self.restart()
+
+        instance = self.instance()
+        key = instance.hystCountKey('dp')
+        self.assertEqual(list(instance.hystCount[key]), [1, 1, 1])
+        self.assertEqual(instance.hystFlag, {key: 1})
+        self.assertEqual(instance.count, {instance.countKey('dp'): 2})
+
+    def testRepeatedEventsSent(self):
+        instance = self.instance(M=0, N=0, K=0, escalateCount=0)
+        for value in (0, 0, 20, 20):
+            self.assertEqual(len(instance.checkRange('dp', value)), 1)
+
+    def testRepeatedEventsSuppressed(self):
+        instance = self.instance(M=0, N=0, K=0, escalateCount=0)
+        stats.reset()
+        refresh = HystThreshold.EVENT_REFRESH
+        HystThreshold.EVENT_REFRESH = 900
+        try:
+            events = [instance.checkRange('dp', value)
+                      for value in (0, 0, 20, 20, 20, 0)]
+        finally:
+            HystThreshold.EVENT_REFRESH = refresh
+        self.assertEqual([len(e) for e in events], [1, 0, 1, 0, 0, 1])
+        self.assertEqual((stats.clears, stats.suppressedClears), (2, 1))
+        self.assertEqual((stats.violations, stats.suppressedEvents), (1, 2))
+
+    def testHysteresisClearResetsEscalation(self):
+        # A clear after K good values ends the violation: the next one
+        # counts from 1 again, as after a clear without hysteresis.
+        instance = self.instance()
+        events = [instance.checkRange('dp', value)
+                  for value in (20, 20, 20, 0, 0)]
+        self.assertEqual(events[2][0]['escalation_count'], 2)
+        self.assertEqual(events[3], [])
+        self.assertEqual(events[4][0]['severity'], 0)
+        self.assertEqual(instance.getCount('dp'), 0)
+        events = instance.checkRange('dp', 20)
+        self.assertEqual(events[0]['escalation_count'], 1)
+        self.assertEqual(events[0]['severity'], 3)
+
+    def testBatchLikeSingleChecks(self):
+        rand = random.Random(5)
+        values = [(rand.choice('abc'), rand.choice((0, 5, 20, None, '30')))
+                  for i in range(500)]
+        single = self.instance(device='single', dpNames='abc')
+        batch = self.instance(device='batch', dpNames='abc')
+        expected = []
+        for dp, value in values:
+            expected.extend(single.checkRange(dp, value))
+        events = []
+        for start in range(0, len(values), 37):
+            events.extend(batch.checkRangeBatch(values[start:start + 37]))
+        for event in expected + events:
+            del event['device']
+        self.assertEqual(events, expected)
+        for dp in 'abc':
+            self.assertEqual(list(batch.hystCount[batch.hystCountKey(dp)]),
+                             list(single.hystCount[single.hystCountKey(dp)]))
+            self.assertEqual(batch.getCount(dp), single.getCount(dp))
+
+    def assertStaysBroken(self, instance):
+        events = instance.checkRange('dp', 20)
+        self.assertEqual(events[0]['severity'], 3)
+        self.assertEqual(instance.checkRange('dp', 0), [])
+        self.assertEqual(instance.getHystFlag('dp'), 1)
+
+    def testBrokenWithoutHistoryKeepsFlag(self):
+        # M was 0: the window only held the flag.
+        instance = self.instance(M=0, N=0, K=0, escalateCount=0)
+        instance.checkRange('dp', 20)
+        self.assertEqual(instance.getHystFlag('dp'), 1)
+        self.assertStaysBroken(self.instance(M=4, N=3, K=2, escalateCount=0))
+
+    def testSwitchedModeKeepsFlag(self):
+        instance = self.instance(M=4, N=2, K=2, escalateCount=0)
+        for value in (20, 20):
+            instance.checkRange('dp', value)
+        self.assertEqual(instance.getHystFlag('dp'), 1)
+        self.assertStaysBroken(self.instance(M=10, N=5, K=5, escalateCount=0,
+                                             timeWindow=True))
+        self.assertStaysBroken(self.instance(M=4, N=3, K=2, escalateCount=0))
+
+    def testResetHystCountClearsFlag(self):
+        instance = self.instance(M=4, N=2, K=2)
+        for value in (20, 20):
+            instance.checkRange('dp', value)
+        instance.resetHystCount('dp')
+        self.assertEqual(instance.getHystFlag('dp'), 0)
+        window = instance.hystCount[instance.hystCountKey('dp')]
+        self.assertEqual(list(window), [])
+        self.assertEqual(instance.getCount('dp'), 1)
+
+    def testKeys(self):
+        instance = self.instance(component='eth0', dpNames='ab')
+        self.assertEqual(instance.hystCountKey('a'), 'dev:thr:a')
+        self.assertEqual(instance.countKey('a'), 'dev:eth0:a')
+        self.assertTrue(instance.hystCountKey('b') is intern('dev:thr:b'))
+        # A datapoint the threshold does not list gets keys too.
+        instance.checkRange('c', 20)
+        self.assertEqual(sorted(instance.configuredKeys()),
+                         ['dev:thr:a', 'dev:thr:b', 'dev:thr:c'])
+        self.assertEqual(list(instance.hystCount['dev:thr:c']), [1])
+        # Built once: a changed context does not change them.
+        instance.context().deviceName = 'other'
+        self.assertEqual(instance.hystCountKey('b'), 'dev:thr:b')
+
+    def copied(self, state):
+        """The instance a collector unjellies from state.
+        """
+        preload = HystThreshold.PRELOAD
+        HystThreshold.PRELOAD = False
+        try:
+            instance = HystThresholdInstance.__new__(HystThresholdInstance)
+            instance.setCopyableState(pickle.loads(pickle.dumps(state, 2)))
+        finally:
+            HystThreshold.PRELOAD = preload
+        return instance
+
+    def assertSameConfig(self, copied, instance):
+        for name in HystThresholdInstance._configAttributes:
+            if name == '_context':
+                self.assertEqual(copied._context.key(),
+                                 instance._context.key())
+            else:
+                self.assertEqual(getattr(copied, name),
+                                 getattr(instance, name))
+        for name in HystThresholdInstance._runtimeAttributes:
+            self.assertFalse(name in copied.__dict__, name)
+
+    def testCopyableState(self):
+        instance = self.instance(dpNames='ab', timeWindow=True)
+        instance.checkRange('a', 20)
+        state = instance.getStateToCopy()
+        self.assertEqual(state[0], HystThreshold.WIRE_VERSION)
+        copied = self.copied(state)
+        self.assertSameConfig(copied, instance)
+        self.assertEqual(copied.hystCountKey('a'), instance.hystCountKey('a'))
+        # The copy attaches to the state the collector holds.
+        self.assertTrue(copied.hystCount is instance.hystCount)
+
+    def testOldCopyableState(self):
+        instance = self.instance(dpNames='ab')
+        for value in (20, 20, 20):
+            instance.checkRange('a', value)
+        key = instance.hystCountKey('a')
+        # Older zenhubs send the whole __dict__, state included.
+        state = dict(instance.__dict__)
+        state.update(hystCount={key: deque([0, 0], 4)}, hystFlag={key: 0},
+                     count={instance.countKey('a'): 0}, _hystLoaded=True)
+        copied = self.copied(state)
+        self.assertSameConfig(copied, instance)
+        self.assertEqual(list(copied.hystCount[key]), [1, 1, 1])
+        self.assertEqual(copied.hystFlag, {key: 1})
+        self.assertEqual(copied.getCount('a'), 2)
+
+
+class GraphPoint(object):
+
+    def __init__(self, rpn=''):
+        self.rpn = rpn
+
+
+class TestGraphElements(unittest.TestCase):
+
+    def setUp(self):
+        HystThreshold._graphCache.clear()
+        HystThreshold._rpnCache.clear()
+        self.calls = []
+        self.rpneval = HystThreshold.rpneval
+        self.talesEvalStr = HystThreshold.talesEvalStr
+        HystThreshold.rpneval = self.fakeRpneval
+        HystThreshold.talesEvalStr = self.fakeTalesEvalStr
+
+    def tearDown(self):
+        HystThreshold.rpneval = self.rpneval
+        HystThreshold.talesEvalStr = self.talesEvalStr
+        HystThreshold._graphCache.clear()
+        HystThreshold._rpnCache.clear()
+
+    def fakeRpneval(self, value, rpn):
+        """Understands "<factor>,*" only.
+        """
+        self.calls.append((value, rpn))
+        return value * float(rpn.split(',')[0])
+
+    def fakeTalesEvalStr(self, express, context):
+        return express.replace('${here/factor}', str(context))
+
+    def lines(self, minval, maxval, rpn='', legend='', context=None):
+        instance = HystThresholdInstance('thr', Context('dev'), ['ds_dp'],
+                                         minval, maxval, 2, 4, 2, '/Perf',
+                                         3, 0)
+        return instance.getGraphElements(None, context, ['DEF:x'], None,
+                                         'ff0000', legend,
+                                         {'ds_dp': GraphPoint(rpn)})
+
+    def testLines(self):
+        self.assertEqual(self.lines(None, 1500),
+                         ['DEF:x', 'HRULE:1500#ff0000:dp greater than '
+                          '1.50k\\j'])
+        self.assertEqual(self.lines(10, 20),
+                         ['DEF:x', 'HRULE:10#ff0000:dp not within 10 and '
+                          '20\\j', 'HRULE:20#ff0000'])
+        self.assertEqual(self.lines(10, 20, legend='limit'),
+                         ['DEF:x', 'HRULE:10#ff0000:limit\\j'])
+        self.assertEqual(self.lines(None, None), ['DEF:x'])
+
+    def testCachedAcrossInstances(self):
+        lines = self.lines(10, 20, rpn='8,*')
+        self.assertEqual(lines[1][:14], 'HRULE:80.0#ff0')
+        self.assertEqual(len(self.calls), 2)
+        # A new instance of the same threshold, as for every render.
+        self.assertEqual(self.lines(10, 20, rpn='8,*'), lines)
+        self.assertEqual(len(self.calls), 2)
+        # A changed threshold or graph point draws its own lines.
+        self.assertNotEqual(self.lines(10, 30, rpn='8,*'), lines)
+        self.assertNotEqual(self.lines(10, 20, rpn='2,*'), lines)
+
+    def testSubstitutedRpn(self):
+        rpn = '${here/factor},*'
+        self.assertEqual(self.lines(None, 20, rpn, context=2)[1][:14],
+                         'HRULE:40.0#ff0')
+        self.assertEqual(self.lines(None, 20, rpn, context=3)[1][:14],
+                         'HRULE:60.0#ff0')
+
+    def testFull(self):
+        size = HystThreshold.GRAPH_CACHE_SIZE
+        HystThreshold.GRAPH_CACHE_SIZE = 3
+        try:
+            for maxval in range(5):
+                self.lines(None, maxval)
+            self.assertTrue(len(HystThreshold._graphCache) <= 3)
+        finally:
+            HystThreshold.GRAPH_CACHE_SIZE = size
+
+
+class TestExpressions(unittest.TestCase):
+
+    def setUp(self):
+        self.evaluated = []
+        self.talesEval = HystThreshold.talesEval
+        HystThreshold.talesEval = self.fakeTalesEval
+        self.threshold = HystThreshold.HystThreshold('thr')
+        self.threshold.dsnames = ['dp']
+
+    def tearDown(self):
+        HystThreshold.talesEval = self.talesEval
+
+    def fakeTalesEval(self, express, context):
+        """Evaluates every expression to the context it is given.
+        """
+        self.evaluated.append(express)
+        if express == 'python:broken':
+            raise NameError('broken')
+        return context
+
+    def limits(self, context):
+        threshold = self.threshold
+        return (threshold.getMinval(context), threshold.getMaxval(context),
+                threshold.getHystN(context), threshold.getHystM(context),
+                threshold.getHystK(context))
+
+    def testLiterals(self):
+        threshold = self.threshold
+        threshold.minval, threshold.maxval = ' 5', '-1.5'
+        threshold.badCount, threshold.queueSize = '3', '12'
+        for context in (1, 2):
+            self.assertEqual(self.limits(context), (5, -1.5, 3, 12, 0))
+        self.assertEqual(self.evaluated, [])
+
+    def testExpressions(self):
+        self.threshold.maxval = 'here.speed * 0.8'
+        self.assertEqual(self.threshold.getMaxval(100), 100)
+        self.assertEqual(self.threshold.getMaxval(200), 200)
+        self.assertEqual(self.evaluated, ['python:here.speed * 0.8'] * 2)
+
+    def testPropertyChanged(self):
+        threshold = self.threshold
+        threshold.badCount = '3'
+        self.assertEqual(threshold.getHystN(1), 3)
+        threshold.badCount = '4'
+        self.assertEqual(threshold.getHystN(1), 4)
+        threshold.badCount = 'here.n'
+        self.assertEqual(threshold.getHystN(7), 7)
+        self.assertEqual(self.evaluated, ['python:here.n'])
+
+    def testBroken(self):
+        self.threshold.minval = 'broken'
+        self.assertRaises(HystThreshold.pythonThresholdException,
+                          self.threshold.getMinval, 1)
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(TestHystThreshold),
+                               unittest.makeSuite(TestGraphElements),
+                               unittest.makeSuite(TestExpressions)))
@@ -0,0 +1,61 @@
+__doc__ = """testHystTune
+Input parsing and output of zenhysttune.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from ZenPacks.community.snmp.HysteresisThreshold import HystTune, HystVector
+
+
+class TestHystTune(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testReadSamples(self):
+        lines = ['timestamp,value\n', '\n', '100,1.5\n', '  \n', '160,U\n',
+                 '220,\n', '280: 3.0e+00 7\n']
+        samples = list(HystTune.readSamples(lines))
+        self.assertEqual(len(samples), 4)
+        self.assertEqual(samples[0], (100.0, 1.5))
+        self.assertEqual(samples[3], (280.0, 3.0))
+        self.assertEqual([t for t, v in samples if v != v], [160.0, 220.0])
+        self.assertEqual(list(HystTune.readSamples(['1\n', '\n', '2\n'])),
+                         [(0, 1.0), (1, 2.0)])
+
+    def main(self, *argv):
+        out, err = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            HystTune.main(list(argv))
+            return sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = out, err
+
+    @unittest.skipIf(HystVector.numpy is None, 'NumPy is not installed')
+    def testJsonWithTimeline(self):
+        path = os.path.join(self.dir, 'values.csv')
+        with open(path, 'w') as f:
+            for i, value in enumerate([10, 90, 90, 90, 10, 10, 10, 10]):
+                f.write('%d,%d\n\n' % (1000 + 60 * i, value))
+        out, err = self.main('--max', '80', '-M', '4', '-N', '2', '-K', '2',
+                             '--json', path)
+        results = json.loads(out)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['samples'], 8)
+        self.assertEqual(results[0]['missing'], 0)
+        self.assertEqual(results[0]['alerts'], 1)
+        self.assertEqual(len(err.splitlines()), 4)
+
+
+def test_suite():
+    return unittest.makeSuite(TestHystTune)
@@ -0,0 +1,133 @@
+__doc__ = """testHystVector
+replay() and backfill() against the same values going through
+checkRange() one at a time.
+"""
+
+import random
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold import HystVector
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystWindow, HystTimeWindow
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+NaN = float('nan')
+
+
+@unittest.skipIf(HystVector.numpy is None, 'NumPy is not installed')
+class TestHystVector(StateTestCase):
+
+    def instance(self, device, minimum, maximum, N, M, K, severity=3,
+                 escalateCount=0):
+        return HystThresholdInstance('thr', Context(device, 'c'), ['dp'],
+                                     minimum, maximum, N, M, K, '/Perf',
+                                     severity, escalateCount)
+
+    def check(self, instance, values):
+        """(event sent, severity, escalation count) of every value.
+        """
+        outcomes = []
+        for value in values:
+            events = instance.checkRange('dp', value)
+            if events:
+                outcomes.append((True, events[0]['severity'],
+                                 events[0].get('escalation_count', 0)))
+            else:
+                outcomes.append((False, 0, 0))
+        return outcomes
+
+    def assertSameWindow(self, window, other):
+        self.assertEqual(window.__class__, other.__class__)
+        self.assertEqual(repr(window), repr(other))
+
+    def testReplayLikeCheckRange(self):
+        rand = random.Random(6)
+        for trial in range(400):
+            M, N, K = [rand.randint(-1, 8) for i in range(3)]
+            minimum, maximum = rand.choice(
+                [(None, 50), (20, None), (20, 50), (50, 20), (None, None)])
+            severity = rand.choice((3, 4, 5))
+            escalateCount = rand.choice((0, 2, 3))
+            instance = self.instance('dev%d' % trial, minimum, maximum,
+                                     N, M, K, severity, escalateCount)
+            self.check(instance, [rand.choice((10, 35, 60))
+                                  for i in range(rand.randint(0, 12))])
+            if rand.random() < 0.2:
+                # M changed by a config push.
+                instance.queueSize = rand.randint(-1, 8)
+            hystKey = instance.hystCountKey('dp')
+            start = instance.hystCount.get(hystKey)
+            if start is not None:
+                start = start.copy()
+            values = [rand.choice((None, 10, 35, 60)) for i in range(40)]
+            expected = self.check(instance, values)
+
+            result = HystVector.replay(
+                [NaN if value is None else value for value in values],
+                minimum, maximum, N, instance.queueSize, K, severity,
+                escalateCount, start, countKey=instance.countKey('dp'))
+            self.assertEqual(
+                zip(result.kinds.astype(bool).tolist(),
+                    result.severities.tolist(), result.counts.tolist()),
+                expected)
+            window = instance.hystCount.get(hystKey)
+            if window is None:
+                self.assertEqual(result.window, None)
+            else:
+                self.assertSameWindow(result.window, window)
+            self.assertEqual(result.count, instance.getCount('dp') or 0)
+
+    def testReplayFromOtherWindows(self):
+        # A window that only held the flag (M was 0), or minutes.
+        rand = random.Random(3)
+        for trial in range(100):
+            M = rand.randint(1, 8)
+            N, K = rand.randint(1, M), rand.randint(1, M)
+            if trial % 2:
+                start = HystWindow(0)
+            else:
+                start = HystTimeWindow(10)
+                start.append(1, 1.0)
+            start.flag = rand.randint(0, 1)
+            instance = self.instance('dev%d' % trial, None, 10, N, M, K,
+                                     escalateCount=2)
+            hystKey = instance.hystCountKey('dp')
+            start.setEscalation(instance.countKey('dp'), rand.randint(0, 3))
+            instance.hystCount[hystKey] = start.copy()
+            values = [rand.choice((5, 20)) for i in range(rand.randint(1, 20))]
+            expected = self.check(instance, values)
+
+            result = HystVector.replay(values, None, 10, N, M, K, 3, 2,
+                                       start.copy(),
+                                       countKey=instance.countKey('dp'))
+            self.assertEqual(result.severities.tolist(),
+                             [severity for sent, severity, count
+                              in expected])
+            self.assertSameWindow(result.window, instance.hystCount[hystKey])
+
+    def testBackfill(self):
+        rand = random.Random(8)
+        history = [rand.choice((5, 20, None)) for i in range(200)]
+        following = [rand.choice((5, 20)) for i in range(50)]
+        checked = self.instance('checked', None, 10, 3, 5, 2,
+                                escalateCount=3)
+        self.check(checked, history)
+        backfilled = self.instance('backfilled', None, 10, 3, 5, 2,
+                                   escalateCount=3)
+        HystVector.backfill(backfilled, 'dp', [NaN if value is None else value
+                                               for value in history])
+        self.assertEqual(self.check(backfilled, following),
+                         self.check(checked, following))
+
+    def testBackfillTimeWindow(self):
+        instance = HystThresholdInstance('thr', Context('dev'), ['dp'], None,
+                                         10, 3, 5, 2, '/Perf', 3, 0, True)
+        self.assertRaises(ValueError, HystVector.backfill, instance, 'dp',
+                          [20, 20])
+
+
+def test_suite():
+    return unittest.makeSuite(TestHystVector)
@@ -0,0 +1,162 @@
+__doc__ = """testHystWindow
+The windows of measurements, by count and by time, and their encoding,
+including the formats of older versions.
+"""
+
+import sys
+import random
+import unittest
+import cPickle as pickle
+from collections import deque
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystWindow, HystTimeWindow, decode, HEADER, OLD_HEADER, OLD_VERSION, \
+    OLD_TIME_HEADER, OLD_TIME_VERSION
+
+
+def state(window):
+    return (window.__class__, window.maxlen, list(window), window.flag,
+            window.escalation, window.bad, window.goodRun)
+
+
+class TestHystWindow(unittest.TestCase):
+
+    def assertRoundTrip(self, window):
+        data = window.encode()
+        self.assertEqual(state(decode(data)), state(window))
+        self.assertEqual(decode(data).encode(), data)
+
+    def assertCounts(self, window, history):
+        values = list(history)
+        self.assertEqual(list(window), values)
+        self.assertEqual(window.count(1), history.count(1))
+        self.assertEqual(window.count(0), history.count(0))
+        goodRun = values[::-1].index(1) if 1 in values else len(values)
+        self.assertEqual(window.goodRun, goodRun)
+
+    def testCounts(self):
+        rand = random.Random(3)
+        for maxlen in (0, 1, 5, 8, 13):
+            window, history = HystWindow(maxlen), deque(maxlen=maxlen)
+            for i in range(60):
+                bad = int(rand.random() < 0.4)
+                window.append(bad)
+                history.append(bad)
+                self.assertCounts(window, history)
+
+    def testResize(self):
+        values = [1, 1, 0, 1, 0, 0, 0, 1, 0, 0]
+        for maxlen in (12, 10, 4, 0):
+            window = HystWindow(6, values, flag=1)
+            window.resize(maxlen)
+            self.assertEqual(window.maxlen, maxlen)
+            self.assertEqual(window.flag, 1)
+            self.assertCounts(window, deque(values[-6:], maxlen))
+
+    def testRoundTrip(self):
+        rand = random.Random(4)
+        for maxlen in (0, 1, 7, 8, 9, 64, 100):
+            for length in (0, maxlen // 2, maxlen, 3 * maxlen + 5):
+                values = [rand.randint(0, 1) for i in range(length)]
+                self.assertRoundTrip(HystWindow(maxlen, values,
+                                                flag=length % 2))
+
+    def testSize(self):
+        window = HystWindow(100, [1] * 150)
+        self.assertEqual(len(window.encode()), HEADER.size + 13)
+
+    def testOldVersion(self):
+        # Version 1 had no escalation counts.
+        window = HystWindow(12, [1, 0, 1, 1, 0] * 4, flag=1)
+        data = OLD_HEADER.pack(OLD_VERSION, 1, 12, window.pos,
+                               window.size) + str(window.bits)
+        decoded = decode(data)
+        self.assertEqual(state(decoded), state(window))
+        self.assertEqual(decoded.escalation, None)
+        self.assertEqual(state(decode(decoded.encode())), state(window))
+
+    def testInvalid(self):
+        data = HystWindow(16, [1, 0, 1]).encode()
+        for bad in (data[:-1], data + 'x', chr(9) + data[1:],
+                    data[:HEADER.size] + '\xff'):
+            self.assertRaises(ValueError, decode, bad)
+
+    def testPickle(self):
+        window = HystWindow(10, [1, 1, 0], flag=1)
+        self.assertEqual(state(pickle.loads(pickle.dumps(window, 2))),
+                         state(window))
+
+
+def timeState(window):
+    return (window.span, window._ordered(), window.start, window.first,
+            window.lastBad, window.flag, window.escalation, window.bad,
+            window.goodRun)
+
+
+class TestHystTimeWindow(unittest.TestCase):
+
+    def testBadTime(self):
+        window = HystTimeWindow(10)
+        # The first measurement stands for no time.
+        window.append(1, 100)
+        self.assertEqual((window.bad, window.goodRun), (0, 0))
+        window.append(1, 101)
+        window.append(1, 102)
+        self.assertEqual((window.bad, window.goodRun), (2, 0))
+        window.append(0, 105)
+        self.assertEqual((window.bad, window.goodRun), (2, 3))
+        window.append(0, 115)
+        self.assertEqual((len(window), window.bad, window.goodRun),
+                         (1, 0, 10))
+        # A missed poll: the bad measurement covers the whole span.
+        window.append(1, 130)
+        self.assertEqual((len(window), window.bad, window.goodRun),
+                         (1, 10, 0))
+        # The clock went back.
+        window.append(0, 129)
+        self.assertEqual(window.last, 130)
+
+    def testRoundTrip(self):
+        rand = random.Random(17)
+        for size in (0, 1, 7, 8, 9, 40):
+            window = HystTimeWindow(300, flag=size % 2)
+            when = 1000.0
+            for i in range(size):
+                when += rand.choice((30, 60, 60, 60, 240))
+                window.append(int(rand.random() < 0.3), when)
+            if size:
+                window.setEscalation('dev:eth0:dp', size)
+            data = window.encode()
+            self.assertEqual(timeState(decode(data)), timeState(window))
+            self.assertEqual(decode(data).encode(), data)
+            copied = decode(data)
+            copied.append(1, when + 60)
+            window.append(1, when + 60)
+            self.assertEqual(timeState(copied), timeState(window))
+
+    def testOldVersion(self):
+        # Version 2 had no escalation counts.
+        window = HystTimeWindow(300, flag=1)
+        for i, bad in enumerate([0, 1, 1, 0, 1]):
+            window.append(bad, 1000 + 60 * i)
+        times, bads = window._ordered()
+        if sys.byteorder == 'little':
+            times.byteswap()
+        data = OLD_TIME_HEADER.pack(
+            OLD_TIME_VERSION, 1, 300, window.start, window.first,
+            window.lastBad, len(window)) + times.tostring() + str(bads)
+        decoded = decode(data)
+        self.assertEqual(timeState(decoded), timeState(window))
+        self.assertEqual(decoded.escalation, None)
+
+    def testInvalid(self):
+        window = HystTimeWindow(300)
+        window.append(1, 1000)
+        data = window.encode()
+        self.assertRaises(ValueError, decode, data[:-1])
+        self.assertRaises(ValueError, decode, data + 'x')
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(TestHystWindow),
+                               unittest.makeSuite(TestHystTimeWindow)))
@@ -0,0 +1,156 @@
+__doc__ = """testJournalStore
+Recovery of the journal store after a crash and its single writer lock.
+"""
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import \
+    JournalStore, HystStoreLocked
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import HystWindow
+
+
+class TestJournalStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test_hystState')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        store = JournalStore(self.path, limit=2 ** 20)
+        self.stores.append(store)
+        return store
+
+    def reopen(self, store):
+        store.close()
+        self.stores.remove(store)
+        return self.open()
+
+    def save(self, store, key, values, flag=0):
+        device, threshold, dp = key.split(':')
+        store.save([(device, threshold,
+                     {key: HystWindow(8, values, flag)}, [key])])
+
+    def history(self, store, device='dev', threshold='thr'):
+        return dict((key, (list(window), window.flag))
+                    for key, window in store.load(device, threshold).items())
+
+    def testTornRecord(self):
+        store = self.open()
+        self.save(store, 'dev:thr:a', [1, 0])
+        self.save(store, 'dev:thr:b', [1, 1], 1)
+        size = os.path.getsize(self.path + '.journal')
+        self.save(store, 'dev:thr:a', [1, 0, 1])
+        store.close()
+        self.stores.remove(store)
+        # The last record is cut short, as by a crash in the middle of
+        # the write.
+        with open(self.path + '.journal', 'r+b') as f:
+            f.truncate(os.path.getsize(self.path + '.journal') - 3)
+        store = self.open()
+        self.assertEqual(self.history(store),
+                         {'dev:thr:a': ([1, 0], 0), 'dev:thr:b': ([1, 1], 1)})
+        self.assertEqual(os.path.getsize(self.path + '.journal'), size)
+        # Records saved after the torn one are not lost behind it.
+        self.save(store, 'dev:thr:c', [0])
+        store = self.reopen(store)
+        self.assertEqual(self.history(store),
+                         {'dev:thr:a': ([1, 0], 0), 'dev:thr:b': ([1, 1], 1),
+                          'dev:thr:c': ([0], 0)})
+
+    def testDamagedRecord(self):
+        store = self.open()
+        self.save(store, 'dev:thr:a', [1])
+        size = os.path.getsize(self.path + '.journal')
+        self.save(store, 'dev:thr:b', [0])
+        self.save(store, 'dev:thr:c', [1])
+        store.close()
+        self.stores.remove(store)
+        with open(self.path + '.journal', 'r+b') as f:
+            f.seek(size + JournalStore.RECORD.size + 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(chr(ord(byte) ^ 0xff))
+        store = self.open()
+        self.assertEqual(self.history(store), {'dev:thr:a': ([1], 0)})
+
+    def testCrashBetweenSnapshotAndTruncate(self):
+        store = self.open()
+        self.save(store, 'dev:thr:a', [1])
+        self.save(store, 'dev:thr:b', [0])
+        self.save(store, 'dev:thr:a', [1, 1], 1)
+        store.deleteKeys(['dev:thr:b'])
+        self.save(store, 'dev:thr:c', [0, 1])
+        store.delete('old', 'thr')
+        with open(self.path + '.journal', 'rb') as f:
+            journal = f.read()
+        expected = self.history(store)
+        store.snapshot()
+        store.close()
+        self.stores.remove(store)
+        # The snapshot was renamed into place but the journal was never
+        # emptied: every record is replayed on top of it.
+        with open(self.path + '.journal', 'wb') as f:
+            f.write(journal)
+        store = self.open()
+        self.assertEqual(self.history(store), expected)
+        self.assertEqual(sorted(store.keys()), ['dev:thr:a', 'dev:thr:c'])
+        self.save(store, 'dev:thr:b', [1])
+        store = self.reopen(store)
+        self.assertEqual(self.history(store)['dev:thr:b'], ([1], 0))
+
+    def testSnapshotSyncsRename(self):
+        store = self.open()
+        self.save(store, 'dev:thr:a', [1])
+        calls = []
+        fsync, rename = os.fsync, os.rename
+
+        def syncing(fd):
+            calls.append(('fsync', stat.S_ISDIR(os.fstat(fd).st_mode)))
+            fsync(fd)
+
+        def renaming(old, new):
+            calls.append(('rename', os.path.basename(new)))
+            rename(old, new)
+        os.fsync, os.rename = syncing, renaming
+        try:
+            store.snapshot()
+        finally:
+            os.fsync, os.rename = fsync, rename
+        # The directory is synced after the rename, before the journal is
+        # emptied.
+        self.assertEqual(calls, [('fsync', False),
+                                 ('rename', 'test_hystState.snapshot'),
+                                 ('fsync', True)])
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+
+    def testLeftoverSnapshotTmp(self):
+        store = self.open()
+        self.save(store, 'dev:thr:a', [1])
+        store.snapshot()
+        self.save(store, 'dev:thr:a', [0, 0])
+        # A crash while the next snapshot was written.
+        with open(self.path + '.snapshot.tmp', 'wb') as f:
+            f.write('partial')
+        store = self.reopen(store)
+        self.assertEqual(self.history(store), {'dev:thr:a': ([0, 0], 0)})
+
+    def testSingleWriter(self):
+        store = self.open()
+        self.assertRaises(HystStoreLocked, JournalStore, self.path)
+        store.close()
+        self.stores.remove(store)
+        self.open()
+
+
+def test_suite():
+    return unittest.makeSuite(TestJournalStore)
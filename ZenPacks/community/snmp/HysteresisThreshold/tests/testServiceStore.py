@@ -0,0 +1,95 @@
+__doc__ = """testServiceStore
+Collectors sharing their hysteresis state through ServiceStore, with a
+file:// service standing in for Redis.
+"""
+
+import os
+import time
+import unittest
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    stateWriter
+from ZenPacks.community.snmp.HysteresisThreshold.HystStore import \
+    ServiceStore, SqliteStore
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import HystWindow
+from ZenPacks.community.snmp.HysteresisThreshold.thresholds.HystThreshold \
+    import HystThresholdInstance
+from ZenPacks.community.snmp.HysteresisThreshold.tests.common import \
+    Context, StateTestCase
+
+
+class TestServiceStore(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        stateWriter._store.close()
+        stateWriter._store = self.store('a')
+
+    def store(self, collector):
+        return ServiceStore(
+            'file://' + os.path.join(self.dir, 'service.db'),
+            SqliteStore(os.path.join(self.dir, '%s.sqlite' % collector)))
+
+    def collector(self, name):
+        """Go on as another collector sharing the service.
+        """
+        self.restart()
+        stateWriter.store.close()
+        stateWriter._store = self.store(name)
+
+    def instance(self):
+        return HystThresholdInstance('thr', Context('dev'), ['dp'], None, 10,
+                                     2, 4, 2, '/Perf', 3, 0)
+
+    def testLoadsLocalCopy(self):
+        store = stateWriter.store
+        store.save([('dev', 'thr', {'dev:thr:dp': HystWindow(4, [1])},
+                     ['dev:thr:dp'])])
+        commands = []
+
+        def execute(sent):
+            commands.append(sent)
+            raise AssertionError('the service was used')
+        store.pool.execute = execute
+        self.assertEqual(list(store.read('dev', 'thr')['dev:thr:dp']), [1])
+        self.assertEqual(commands, [])
+
+    def testFetchedFromOtherCollector(self):
+        instance = self.instance()
+        for value in (20, 20, 0):
+            instance.checkRange('dp', value)
+        key = instance.hystCountKey('dp')
+        self.collector('b')
+
+        instance = self.instance()
+        self.assertEqual(list(instance.hystCount[key]), [1, 1, 0])
+        self.assertEqual(instance.getHystFlag('dp'), 1)
+        instance.checkRange('dp', 0)
+        self.collector('a')
+
+        # The local copy of a lags behind until the service is read.
+        self.assertEqual(list(stateWriter.store.read('dev', 'thr')[key]),
+                         [1, 1, 0])
+        self.assertEqual(list(self.instance().hystCount[key]), [1, 1, 0, 0])
+
+    def testFetchKeepsUnsentChanges(self):
+        other = self.store('b')
+        other.save([('dev', 'thr', {'dev:thr:x': HystWindow(4, [1]),
+                                    'dev:thr:y': HystWindow(4, [1])},
+                     ['dev:thr:x', 'dev:thr:y'])])
+        other.close()
+        store = stateWriter.store
+        # Saved while the service could not be reached.
+        store._retry = time.time() + 60
+        store.save([('dev', 'thr', {'dev:thr:x': HystWindow(4, [0])},
+                     ['dev:thr:x'])])
+        store._retry = 0
+        fetched = store.fetch([('dev', 'thr')])
+        self.assertEqual(fetched.keys(), [('dev', 'thr')])
+        self.assertEqual(fetched[('dev', 'thr')].keys(), ['dev:thr:y'])
+        # Read again only once another collector saved.
+        self.assertEqual(store.fetch([('dev', 'thr')]), {})
+
+
+def test_suite():
+    return unittest.makeSuite(TestServiceStore)
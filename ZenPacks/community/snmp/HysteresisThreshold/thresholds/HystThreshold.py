@@ -15,9 +15,9 @@ Make threshold comparisons dynamic by using TALES expresssions,
 rather than just number bounds checking.
 """
 
-from Products.ZenUtils.Utils import zenPath, atomicWrite
-import cPickle as pickle
-from collections import deque
+import os
+import time
+from ast import literal_eval
 from AccessControl import Permissions
 
 from Globals import InitializeClass
@@ -28,19 +28,61 @@ from Products.ZenEvents.ZenEventClasses import Perf_Snmp
 from Products.ZenUtils.ZenTales import talesEval, talesEvalStr
 from Products.ZenEvents.Exceptions import pythonThresholdException, \
     rpnThresholdException
-
-import logging
-log = logging.getLogger('zen.HysteresisThreshold')
-
 from Products.ZenUtils.Utils import unused, nanToNone
 
 # Note:  this import is for backwards compatibility.
 # Import Products.ZenRRD.utils.rpneval directy.
 from Products.ZenRRD.utils import rpneval
+from twisted.spread import pb
+
+from ZenPacks.community.snmp.HysteresisThreshold.HystState import \
+    stateWriter, registry, PRELOAD
+from ZenPacks.community.snmp.HysteresisThreshold.HystStats import \
+    stats, installSignalHandler
+from ZenPacks.community.snmp.HysteresisThreshold.HystTrace import tracer
+from ZenPacks.community.snmp.HysteresisThreshold.HystWindow import \
+    HystWindow, HystTimeWindow
+
+import logging
+log = logging.getLogger('zen.HysteresisThreshold')
 
 NaN = float('nan')
 
 
+def _intern(key):
+    if type(key) is str:
+        return intern(key)
+    return key
+
+
+# HRULE commands of getGraphElements() and the rpneval() results behind
+# them.  Graphs are rendered with new instances every time, so both are
+# kept per process, and emptied once they hold this many entries.
+GRAPH_CACHE_SIZE = 4096
+_graphCache = {}
+_rpnCache = {}
+
+
+def _rpneval(value, rpn):
+    key = (value, rpn)
+    result = _rpnCache.get(key)
+    if result is None:
+        result = rpneval(value, rpn)
+        if len(_rpnCache) >= GRAPH_CACHE_SIZE:
+            _rpnCache.clear()
+        _rpnCache[key] = result
+    return result
+
+
+# Marks the state getStateToCopy() sends.
+WIRE_VERSION = 'hyst1'
+
+# When set, an event of the same severity as the last one sent for a
+# datapoint is only sent again after this many seconds.  Zero (the
+# default) sends every event.
+EVENT_REFRESH = float(os.environ.get('ZENHYST_EVENT_REFRESH', 0))
+
+
 class HystThreshold(ThresholdClass):
     """
     Threshold class that can evaluate RPNs and Python expressions
@@ -54,6 +96,8 @@ class HystThreshold(ThresholdClass):
     eventClass = Perf_Snmp
     severity = 3
     escalateCount = 0
+    # M, N and K are minutes rather than measurements.
+    timeWindow = False
 
     _properties = ThresholdClass._properties + (
         {'id': 'minval',        'type': 'string', 'mode': 'w'},
@@ -64,7 +108,9 @@ class HystThreshold(ThresholdClass):
                   'after K sequential clear measurements'},
         {'id': 'queueSize',     'type': 'string', 'mode': 'w'},
         {'id': 'goodCount',     'type': 'string', 'mode': 'w'},
-        {'id': 'escalateCount', 'type': 'int',    'mode': 'w'}
+        {'id': 'escalateCount', 'type': 'int',    'mode': 'w'},
+        {'id': 'timeWindow',    'type': 'boolean', 'mode': 'w',
+         'label': 'Count M, N and K in minutes instead of measurements'}
         )
 
     factory_type_information = (
@@ -95,25 +141,46 @@ class HystThreshold(ThresholdClass):
                                     goodCount=self.getHystK(context),
                                     eventClass=self.eventClass,
                                     severity=self.severity,
-                                    escalateCount=self.escalateCount)
+                                    escalateCount=self.escalateCount,
+                                    timeWindow=self.timeWindow)
         return mmt
 
+    def _evalExpression(self, attr, context, what):
+        """Evaluate the Python expression held by property attr.
+
+        Parsed expressions are cached per threshold in a volatile
+        attribute and reparsed when the property changes.  Plain
+        literals such as "7" never go through TALES.
+        """
+        source = getattr(self, attr)
+        cache = getattr(self, '_v_expressions', None)
+        if cache is None:
+            cache = self._v_expressions = {}
+        cached = cache.get(attr)
+        if cached is None or cached[0] != source:
+            try:
+                cached = (source, True, literal_eval(source.strip()))
+            except (ValueError, SyntaxError, TypeError):
+                cached = (source, False, "python:%s" % source)
+            cache[attr] = cached
+        if cached[1]:
+            return cached[2]
+        try:
+            return talesEval(cached[2], context)
+        except Exception:
+            msg = (
+                "User-supplied Python expression (%s) for "
+                "%s caused error: %s"
+                ) % (source, what, self.dsnames)
+            log.error(msg)
+            raise pythonThresholdException(msg)
+
     def getMinval(self, context):
         """Build the min value for this threshold.
         """
         minval = None
         if self.minval:
-            try:
-                express = "python:%s" % self.minval
-                minval = talesEval(express, context)
-            except:
-                msg = (
-                    "User-supplied Python expression (%s) for "
-                    "minimum value caused error: %s"
-                    ) % (self.minval,  self.dsnames)
-                log.error(msg)
-                raise pythonThresholdException(msg)
-                minval = None
+            minval = self._evalExpression('minval', context, 'minimum value')
         return nanToNone(minval)
 
     def getMaxval(self, context):
@@ -121,17 +188,7 @@ class HystThreshold(ThresholdClass):
         """
         maxval = None
         if self.maxval:
-            try:
-                express = "python:%s" % self.maxval
-                maxval = talesEval(express, context)
-            except:
-                msg = (
-                    "User-supplied Python expression (%s) for "
-                    "maximum value caused error: %s"
-                    ) % (self.maxval,  self.dsnames)
-                log.error(msg)
-                raise pythonThresholdException(msg)
-                maxval = None
+            maxval = self._evalExpression('maxval', context, 'maximum value')
         return nanToNone(maxval)
 
     def getHystN(self, context):
@@ -139,17 +196,8 @@ class HystThreshold(ThresholdClass):
         """
         badCount = 0
         if self.badCount:
-            try:
-                express = "python:%s" % self.badCount
-                badCount = talesEval(express, context)
-            except:
-                msg = (
-                    "User-supplied Python expression (%s) for "
-                    "hysteresis N value caused error: %s"
-                    ) % (self.badCount,  self.dsnames)
-                log.error(msg)
-                raise pythonThresholdException(msg)
-                badCount = 0
+            badCount = self._evalExpression('badCount', context,
+                                            'hysteresis N value')
         return badCount
 
     def getHystM(self, context):
@@ -157,17 +205,8 @@ class HystThreshold(ThresholdClass):
         """
         queueSize = 0
         if self.queueSize:
-            try:
-                express = "python:%s" % self.queueSize
-                queueSize = talesEval(express, context)
-            except:
-                msg = (
-                    "User-supplied Python expression (%s) for "
-                    "hysteresis M value caused error: %s"
-                    ) % (self.queueSize,  self.dsnames)
-                log.error(msg)
-                raise pythonThresholdException(msg)
-                queueSize = 0
+            queueSize = self._evalExpression('queueSize', context,
+                                             'hysteresis M value')
         return queueSize
 
     def getHystK(self, context):
@@ -175,17 +214,8 @@ class HystThreshold(ThresholdClass):
         """
         goodCount = 0
         if self.goodCount:
-            try:
-                express = "python:%s" % self.goodCount
-                goodCount = talesEval(express, context)
-            except:
-                msg = (
-                    "User-supplied Python expression (%s) for "
-                    "hysteresis K value caused error: %s"
-                    ) % (self.goodCount,  self.dsnames)
-                log.error(msg)
-                raise pythonThresholdException(msg)
-                goodCount = 0
+            goodCount = self._evalExpression('goodCount', context,
+                                             'hysteresis K value')
         return goodCount
 
 
@@ -194,134 +224,374 @@ HystThresholdClass = HystThreshold
 
 
 class HystThresholdInstance(RRDThresholdInstance):
-    # Not strictly necessary, but helps when restoring instances from
-    # pickle files that were not constructed with a count member.
-    count = {}
-    hystCount = {}
-    hystFlag = {}
+    # The hysteresis state itself lives in the shared registry entry of
+    # the device and threshold, attached on the first check.
+    _hystEntry = None
+    # Parts of the events that are the same for every value, built by
+    # _buildEventTemplate() on first use.
+    _eventTemplate = None
+    _summaryFormats = None
+    # (hystCountKey, countKey) of every datapoint, built by _buildKeys()
+    # on first use: zenhub makes the instances and copies them over to
+    # the collector.
+    _dpKeys = None
+    # Attributes that belong to the process checking the instance rather
+    # than to its configuration.
+    # hystCount, count, hystFlag and _hystLoaded were set by older
+    # versions.
+    _runtimeAttributes = ('_hystCount', '_emitted', '_hystDirty',
+                          '_hystEntry', '_dpKeys', '_eventTemplate',
+                          '_summaryFormats', 'hystCount', 'count',
+                          'hystFlag', '_hystLoaded')
+    # What zenhub sends the collectors, in this order; see getStateToCopy().
+    _configAttributes = ('id', '_context', 'dataPointNames', 'eventClass',
+                         'severity', 'minimum', 'maximum', 'badCount',
+                         'queueSize', 'goodCount', 'escalateCount',
+                         'timeWindow')
 
     def __init__(self, id, context, dpNames,
                  minval, maxval, badCount, queueSize, goodCount,
-                 eventClass, severity, escalateCount):
+                 eventClass, severity, escalateCount, timeWindow=False):
         RRDThresholdInstance.__init__(self, id, context, dpNames,
                                       eventClass, severity)
-        self.count = {}
-        self.hystCount = {}
-        self.hystFlag = {}
+        registry.instances.add(self)
         self.minimum = minval
         self.maximum = maxval
         self.badCount = badCount
         self.queueSize = queueSize
         self.goodCount = goodCount
         self.escalateCount = escalateCount
+        self.timeWindow = timeWindow
+
+    def getStateToCopy(self):
+        """Only the configuration goes to the collector: the values of
+        _configAttributes as a list, so the attribute names aren't sent
+        with every instance, and any other attribute the base class set.
+        The collector attaches the instance to its own state.
+        """
+        state = self.__dict__
+        skip = set(self._configAttributes + self._runtimeAttributes)
+        return [WIRE_VERSION,
+                [state.get(name) for name in self._configAttributes],
+                dict((name, value) for name, value in state.iteritems()
+                     if name not in skip)]
+
+    def setCopyableState(self, state):
+        if PRELOAD:
+            # The first config of a daemon: read the state it saved before
+            # the first cycle needs it.
+            registry.preloadInBackground()
+        registry.instances.add(self)
+        if isinstance(state, list) and state and state[0] == WIRE_VERSION:
+            version, values, others = state
+            self.__dict__.update(others)
+            self.__dict__.update(zip(self._configAttributes, values))
+        else:
+            # The whole __dict__, as older zenhubs send it.
+            for name in self._runtimeAttributes:
+                state.pop(name, None)
+            self.__dict__.update(state)
+
+    @property
+    def hystCount(self):
+        """The windows of the datapoints, by hystCountKey.
+        """
+        self.ensureHystState()
+        return self._hystCount
+
+    @property
+    def hystFlag(self):
+        """The broken flags of the datapoints, by hystCountKey.  The flags
+        are kept in the windows, so this is a copy.
+        """
+        self.ensureHystState()
+        return dict((key, window.flag)
+                    for key, window in self._hystCount.iteritems())
+
+    @property
+    def count(self):
+        """The escalation counts of the datapoints of this instance, by
+        countKey.  The counts are kept in the windows, so this is a copy.
+        """
+        self.ensureHystState()
+        counts = {}
+        for dp in self.dataPointNames:
+            hystKey, countKey = self._keys(dp)
+            window = self._hystCount.get(hystKey)
+            if window is not None and window.escalationOf(countKey):
+                counts[countKey] = window.escalationOf(countKey)
+        return counts
 
     def hystCountKey(self, dp):
-        return self.context().deviceName + ':' + self.name() + ':' + dp
+        return self._keys(dp)[0]
 
     def countKey(self, dp):
-        return ':'.join(self.context().key()) + ':' + dp
-
-    def saveHystState(self):
-        log.debug("saving hysteresis state")
-        atomicWrite(
-            zenPath('var/%s_%s_hystCount.pickle' % (self.context().deviceName,
-                                                    self.name())),
-            pickle.dumps(self.hystCount),
-            raiseException=False,
-        )
-        atomicWrite(
-            zenPath('var/%s_%s_hystFlag.pickle' % (self.context().deviceName,
-                                                   self.name())),
-            pickle.dumps(self.hystFlag),
-            raiseException=False,
-        )
+        return self._keys(dp)[1]
+
+    def configuredKeys(self):
+        """hystCountKeys of the datapoints of the instance, and of any
+        other datapoint it was asked to check.
+        """
+        for dp in self.dataPointNames:
+            self._keys(dp)
+        return [keys[0] for keys in self._dpKeys.itervalues()]
+
+    def _keys(self, dp):
+        """(hystCountKey, countKey) of dp.
+        """
+        try:
+            return self._dpKeys[dp]
+        except (KeyError, TypeError):
+            return self._buildKeys(dp)
+
+    def _buildKeys(self, dp):
+        """Build and cache the state keys of dp, and on first use those
+        of every datapoint of the threshold.  The keys are interned, so
+        the state dictionaries compare them by identity.
+        """
+        dpKeys = self._dpKeys
+        if dpKeys is None:
+            dpKeys = self._dpKeys = {}
+            for name in self.dataPointNames:
+                self._buildKeys(name)
+        context = self.context()
+        hystPrefix = context.deviceName + ':' + self.name() + ':'
+        countPrefix = ':'.join(context.key()) + ':'
+        keys = dpKeys[dp] = (_intern(hystPrefix + dp),
+                             _intern(countPrefix + dp))
+        return keys
+
+    def hystStateKey(self):
+        return (self.context().deviceName, self.name())
+
+    def saveHystState(self, dp=None):
+        """Mark the hysteresis state of dp (or of all datapoints) as
+        changed.  It is saved by the state writer on its next flush.
+        """
+        self.ensureHystState()
+        if dp is None:
+            self._hystDirty.update(self._hystCount)
+        else:
+            self._hystDirty.add(self.hystCountKey(dp))
+        stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
 
     def loadHystState(self):
+        """Attach to the shared state of this device and threshold.  It
+        is only read from the store when no other instance (e.g. the one
+        this instance replaces after a config push) has it in memory.
+        """
         log.debug("Loading hyst state")
-        try:
-            self.hystCount = pickle.load(
-                open(zenPath('var/%s_%s_hystCount.pickle' %
-                     (self.context().deviceName, self.name()))))
-            log.debug("restored %r", self.hystCount)
-        except Exception:
-            log.debug("error loading %s",
-                      zenPath('var/%s_%s_hystCount.pickle' %
-                              (self.context().deviceName, self.name())))
-            pass
-        try:
-            self.hystFlag = pickle.load(
-                open(zenPath('var/%s_%s_hystFlag.pickle' %
-                     (self.context().deviceName, self.name()))))
-            log.debug("restored %r", self.hystFlag)
-        except Exception:
-            log.debug("error loading %s",
-                      zenPath('var/%s_%s_hystFlag.pickle' %
-                              (self.context().deviceName, self.name())))
-            pass
+        installSignalHandler()
+        entry = registry.attach(self.context().deviceName, self.name())
+        self._hystEntry = entry
+        self._hystCount = entry.hystCount
+        self._emitted = entry.emitted
+        self._hystDirty = entry.dirty
+
+    def ensureHystState(self):
+        """Attach to the hysteresis state once, and again after the
+        registry evicted it.  The in-memory copy is authoritative.
+        """
+        entry = self._hystEntry
+        if entry is None or not entry.live:
+            self.loadHystState()
 
     def getHystCount(self, dp):
+        self.ensureHystState()
         countKey = self.hystCountKey(dp)
-        if not countKey in self.hystCount:
+        if countKey not in self._hystCount:
             return 0
-        return self.hystCount[countKey].count(1)
+        return self._hystCount[countKey].bad
 
+    # The escalation count of a datapoint is kept in its window, so it is
+    # saved along with the history and the flag.  The components of the
+    # device share the window, so it holds a count per countKey.
     def getCount(self, dp):
-        countKey = self.countKey(dp)
-        if not countKey in self.count:
+        self.ensureHystState()
+        hystKey, countKey = self._keys(dp)
+        window = self._hystCount.get(hystKey)
+        if window is None:
             return None
-        return self.count[countKey]
+        return window.escalationOf(countKey)
 
     def incrementCount(self, dp):
-        countKey = self.countKey(dp)
-        if not countKey in self.count:
-            self.resetCount(dp)
-        self.count[countKey] += 1
-        return self.count[countKey]
+        self.ensureHystState()
+        count = self._incrementCount(*self._keys(dp))
+        stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
+        return count
+
+    def _incrementCount(self, hystKey, countKey):
+        window = self._hystCount.get(hystKey)
+        if window is None:
+            window = self._hystCount[hystKey] = HystWindow(0)
+        count = window.escalationOf(countKey) + 1
+        window.setEscalation(countKey, count)
+        self._hystDirty.add(hystKey)
+        return count
+
+    def _resetCount(self, hystKey, countKey):
+        window = self._hystCount.get(hystKey)
+        if window is not None and window.escalationOf(countKey):
+            window.setEscalation(countKey, 0)
+            self._hystDirty.add(hystKey)
 
     # bad is 1 for a bad  measurement and
     #        0 for a good measurement
+    # Returns the number of bad measurements in the window for a bad one,
+    # and the current run of good measurements (capped at K) for a good one.
+    # With timeWindow set both are minutes instead.
     def incrementHystCount(self, dp, bad):
-        self.loadHystState()
+        self.ensureHystState()
+        hystCount = self._incrementHystCount(self.hystCountKey(dp), bad,
+                                             time.time())
+        stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
+        return hystCount
+
+    def _newWindow(self, old=None):
+        """Empty window, taking over the broken flag and the escalation
+        counts of old, e.g. when M was 0 or the threshold switched between
+        counting measurements and minutes.
+        """
+        if self.timeWindow:
+            window = HystTimeWindow(self.queueSize)
+        else:
+            window = HystWindow(self.queueSize)
+        if old is not None:
+            window.flag = old.flag
+            window.escalation = old.escalation
+        return window
 
+    def _incrementHystCount(self, countKey, bad, now):
         # if start hysteresis is not set - just return 0
         if self.queueSize <= 0:
             return 0
 
-        countKey = self.hystCountKey(dp)
-        if not countKey in self.hystCount:
-            self.resetHystCount(dp)
-        self.hystCount[countKey].append(bad)
-        self.saveHystState()
+        window = self._hystCount.get(countKey)
+        if self.timeWindow:
+            if window is None or window.__class__ is not HystTimeWindow:
+                window = self._hystCount[countKey] = self._newWindow(window)
+            elif window.span != self.queueSize:
+                window.span = self.queueSize
+            window.append(bad, now / 60.0)
+        else:
+            if window is None or window.__class__ is not HystWindow or \
+                    not window.maxlen:
+                window = self._hystCount[countKey] = self._newWindow(window)
+            elif window.maxlen != self.queueSize:
+                # M changed: keep the newest measurements that fit.
+                nbytes = window.nbytes
+                window.resize(self.queueSize)
+                stats.reclaimedBytes += max(nbytes - window.nbytes, 0)
+            window.append(bad)
+        self._hystDirty.add(countKey)
         if bad:
-            return self.hystCount[countKey].count(bad)
+            return window.bad
         else:
-            return list(self.hystCount[countKey])[-self.goodCount:].count(bad)
+            return min(window.goodRun, self.goodCount)
+
+    def getHystFlag(self, dp):
+        self.ensureHystState()
+        return self._getHystFlag(self.hystCountKey(dp))
+
+    def _getHystFlag(self, countKey):
+        window = self._hystCount.get(countKey)
+        if window is None:
+            return 0
+        return window.flag
 
     def setHystFlag(self, dp, state):
-        self.hystFlag[self.hystCountKey(dp)] = state
-        self.saveHystState()
+        self.ensureHystState()
+        self._setHystFlag(self.hystCountKey(dp), state)
+        stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
+
+    def _setHystFlag(self, countKey, state):
+        window = self._hystCount.get(countKey)
+        if window is None:
+            # Without a history (M is 0) the window only carries the flag.
+            window = self._hystCount[countKey] = HystWindow(0)
+        window.flag = state
+        self._hystDirty.add(countKey)
 
     def resetHystCount(self, dp):
-        self.hystCount[self.hystCountKey(dp)] = deque(maxlen=self.queueSize)
-        self.hystFlag[self.hystCountKey(dp)] = 0
-        self.saveHystState()
+        self.ensureHystState()
+        countKey = self.hystCountKey(dp)
+        window = self._hystCount[countKey] = self._newWindow(
+            self._hystCount.get(countKey))
+        window.flag = 0
+        self.saveHystState(dp)
 
     def resetCount(self, dp):
-        self.count[self.countKey(dp)] = 0
+        self.ensureHystState()
+        self._resetCount(*self._keys(dp))
+        if self._hystDirty:
+            stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
 
     def checkRange(self, dp, value):
         'Check the value for min/max thresholds'
-        log.debug(
-            ("Checking %s %s against min %s, max %s, "
-             "badCount '%s'('%s'), queueSize '%s', "
-             "goodCount '%s',  hystKey %s"),
-            dp, value, self.minimum, self.maximum, self.badCount,
-            self.getHystCount(dp), self.queueSize,
-            self.goodCount, self.hystCountKey(dp))
+        started = time.time()
+        self.ensureHystState()
+        self._hystEntry.used = started
+        try:
+            hystKey, countKey = self._dpKeys[dp]
+        except (KeyError, TypeError):
+            hystKey, countKey = self._buildKeys(dp)
+        result = self._checkRange(dp, hystKey, countKey, value, started)
+        level = tracer.level(self.context().deviceName)
+        if level:
+            tracer.sample(level, self, dp, hystKey, value, result)
+        if self._hystDirty:
+            stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
+        stats.checkTime += time.time() - started
+        return result
+
+    def checkRangeBatch(self, values):
+        """Check many values at once.
+
+        @parameter values: (datapoint, value) pairs in the order they were
+            collected, or a dictionary mapping datapoints to values
+        @rtype: list of dictionaries, the events checkRange would have
+            returned for each value in turn
+        """
+        if isinstance(values, dict):
+            values = values.iteritems()
+        started = time.time()
+        self.ensureHystState()
+        self._hystEntry.used = started
+        level = tracer.level(self.context().deviceName)
+        result = []
+        for dp, value in values:
+            try:
+                hystKey, countKey = self._dpKeys[dp]
+            except (KeyError, TypeError):
+                hystKey, countKey = self._buildKeys(dp)
+            events = self._checkRange(dp, hystKey, countKey, value, started)
+            if level:
+                tracer.sample(level, self, dp, hystKey, value, events)
+            result.extend(events)
+        if self._hystDirty:
+            stateWriter.markDirty(self._hystEntry.key, self._hystEntry)
+        stats.checkTime += time.time() - started
+        return result
+
+    def _suppressEvent(self, countKey, severity, how, now):
+        """True when the same event was sent for countKey less than
+        EVENT_REFRESH seconds ago, so this one can be left out.
+        """
+        if EVENT_REFRESH <= 0:
+            return False
+        last = self._emitted.get(countKey)
+        if last is not None and last[0] == severity and last[1] == how \
+                and now - last[2] < EVENT_REFRESH:
+            return True
+        self._emitted[countKey] = (severity, how, now)
+        return False
+
+    def _checkRange(self, dp, hystKey, countKey, value, now):
         if value is None:
             return []
         if isinstance(value, basestring):
             value = float(value)
+        stats.samples += 1
         thresh = None
 
         # Handle all cases where both minimum and maximum are set.
@@ -347,61 +617,107 @@ class HystThresholdInstance(RRDThresholdInstance):
 
         if thresh is not None:
             severity = 2  # self.severity
-            hystCount = self.incrementHystCount(dp, 1)
+            count = None
+            escalated = False
+            hystCount = self._incrementHystCount(hystKey, 1, now)
             # if current hysteresis count at least reached
             # a limit of 'self.badCount'
             # restore original severity and mark a threshold as violated
             # begin event counting for escalation
-            if (self.badCount - 1) < hystCount or \
-                    self.hystFlag[self.hystCountKey(dp)] == 1:
+            if hystCount >= self.badCount or \
+                    self._getHystFlag(hystKey) == 1:
                 severity = self.severity
-                count = self.incrementCount(dp)
-                self.setHystFlag(dp, 1)
+                count = self._incrementCount(hystKey, countKey)
+                self._setHystFlag(hystKey, 1)
                 if self.escalateCount and count >= self.escalateCount:
                     severity = min(severity + 1, 5)
+                    escalated = True
 
-            summary = 'threshold of %s %s: current value %f.' % (
-                self.name(), how, float(value))
+            if self._suppressEvent(countKey, severity, how, now):
+                stats.suppressedEvents += 1
+                return []
+            if count is None:
+                stats.notices += 1
+            else:
+                stats.violations += 1
+                if escalated:
+                    stats.escalations += 1
+            summary = self._summary(how, float(value))
             evtdict = self._create_event_dict(value, summary, severity, how)
-            if self.escalateCount:
+            if self.escalateCount and count is not None:
                 evtdict['escalation_count'] = count
 
             return self.processEvent(evtdict)
         else:
-            hystCount = self.incrementHystCount(dp, 0)
+            hystCount = self._incrementHystCount(hystKey, 0, now)
             # if hysteresis didn't kick in propagate event further
-            if self.hystFlag[self.hystCountKey(dp)] == 0:
-                summary = 'threshold of %s restored: current value %f' % (
-                    self.name(), value)
-                self.resetCount(dp)
+            if self._getHystFlag(hystKey) == 0:
+                self._resetCount(hystKey, countKey)
+                if self._suppressEvent(countKey, Event.Clear, None, now):
+                    stats.suppressedClears += 1
+                    return []
+                stats.clears += 1
+                summary = self._summary(None, value)
                 return self.processClearEvent(
                     self._create_event_dict(value, summary, Event.Clear))
             else:
-                #if hysteresis enabled wait till at least K clearing events
+                # if hysteresis enabled wait till at least K clearing events
                 if hystCount < self.goodCount:
+                    stats.heldClears += 1
                     return []
                 else:
                     # at least K clearing events. Allow faster clearing
-                    self.setHystFlag(dp, 0)
+                    self._setHystFlag(hystKey, 0)
+                    self._resetCount(hystKey, countKey)
+                    if self._suppressEvent(countKey, Event.Clear, None, now):
+                        stats.suppressedClears += 1
+                        return []
+                    stats.clears += 1
+                    summary = self._summary(None, value)
                     return self.processClearEvent(
                         self._create_event_dict(value, summary, Event.Clear))
 
-    def _create_event_dict(self, current, summary, severity, how=None):
-        event_dict = dict(device=self.context().deviceName,
-                          summary=summary,
-                          eventKey=self.id,
-                          eventClass=self.eventClass,
-                          component=self.context().componentName,
-                          min=self.minimum,
-                          max=self.maximum,
-                          current=current,
-                          severity=severity)
-        deviceUrl = getattr(self.context(), "deviceUrl", None)
+    def _buildEventTemplate(self):
+        """Build the event fields and summary formats that only depend
+        on the configuration of this instance.
+        """
+        context = self.context()
+        template = dict(device=context.deviceName,
+                        eventKey=self.id,
+                        eventClass=self.eventClass,
+                        component=context.componentName,
+                        min=self.minimum,
+                        max=self.maximum)
+        deviceUrl = getattr(context, "deviceUrl", None)
         if deviceUrl is not None:
-            event_dict["zenoss.device.url"] = deviceUrl
-        devicePath = getattr(self.context(), "devicePath", None)
+            template["zenoss.device.url"] = deviceUrl
+        devicePath = getattr(context, "devicePath", None)
         if devicePath is not None:
-            event_dict["zenoss.device.path"] = devicePath
+            template["zenoss.device.path"] = devicePath
+        name = self.name().replace('%', '%%')
+        formats = {None: 'threshold of %s restored: current value %%f' % name}
+        for how in ('exceeded', 'not met', 'violated'):
+            formats[how] = 'threshold of %s %s: current value %%f.' % (
+                name, how)
+        self._summaryFormats = formats
+        self._eventTemplate = template
+        return template
+
+    def _summary(self, how, value):
+        formats = self._summaryFormats
+        if formats is None:
+            self._buildEventTemplate()
+            formats = self._summaryFormats
+        return formats[how] % value
+
+    def _create_event_dict(self, current, summary, severity, how=None):
+        event_dict = self._eventTemplate
+        if event_dict is None:
+            event_dict = self._buildEventTemplate()
+        event_dict = event_dict.copy()
+        event_dict['summary'] = summary
+        event_dict['current'] = current
+        event_dict['severity'] = severity
         if how is not None:
             event_dict['how'] = how
         return event_dict
@@ -445,37 +761,53 @@ class HystThresholdInstance(RRDThresholdInstance):
         unused(template, namespace)
         if not color.startswith('#'):
             color = '#%s' % color
-        minval = self.minimum
-        if minval is None:
-            minval = NaN
-        maxval = self.maximum
-        if maxval is None:
-            maxval = NaN
-        hystval = self.hystval
-        if hystval is None:
-            hystval = NaN
         if not self.dataPointNames:
             return gopts
         gp = relatedGps[self.dataPointNames[0]]
 
-        # Attempt any RPN expressions
+        # Attempt any RPN expressions.  Only TALES substitutions depend on
+        # the context; a plain RPN expression is used as it is.
         rpn = getattr(gp, 'rpn', None)
-        if rpn:
+        if rpn and ('$' in rpn or rpn.startswith('string:')):
             try:
                 rpn = talesEvalStr(rpn, context)
-            except:
+            except Exception:
                 self.raiseRPNExc()
                 return gopts
 
+        # The rules only depend on what goes into the key, so a changed
+        # threshold or graph point gets a key of its own.
+        key = (rpn, self.minimum, self.maximum, legend, color,
+               tuple(self.dataPointNames))
+        lines = _graphCache.get(key)
+        if lines is None:
+            lines = self._graphLines(rpn, legend, color, relatedGps)
+            if len(_graphCache) >= GRAPH_CACHE_SIZE:
+                _graphCache.clear()
+            _graphCache[key] = lines
+        gopts.extend(lines)
+        return gopts
+
+    def _graphLines(self, rpn, legend, color, relatedGps):
+        """HRULE commands of getGraphElements().
+        """
+        minval = self.minimum
+        if minval is None:
+            minval = NaN
+        maxval = self.maximum
+        if maxval is None:
+            maxval = NaN
+
+        if rpn:
             try:
-                minval = rpneval(minval, rpn)
-            except:
+                minval = _rpneval(minval, rpn)
+            except Exception:
                 minval = 0
                 self.raiseRPNExc()
 
             try:
-                maxval = rpneval(maxval, rpn)
-            except:
+                maxval = _rpneval(maxval, rpn)
+            except Exception:
                 maxval = 0
                 self.raiseRPNExc()
 
@@ -484,34 +816,34 @@ class HystThresholdInstance(RRDThresholdInstance):
 
         minval = nanToNone(minval)
         maxval = nanToNone(maxval)
+        lines = []
         if legend:
-            gopts.append(
+            lines.append(
                 "HRULE:%s%s:%s\\j" % (minval or maxval, color, legend))
         elif minval is not None and maxval is not None:
             if minval == maxval:
-                gopts.append(
+                lines.append(
                     "HRULE:%s%s:%s not equal to %s\\j" %
                     (minval, color, self.getNames(relatedGps), minstr))
             elif minval < maxval:
-                gopts.append(
+                lines.append(
                     "HRULE:%s%s:%s not within %s and %s\\j" %
                     (minval, color, self.getNames(relatedGps), minstr, maxstr))
-                gopts.append("HRULE:%s%s" % (maxval, color))
+                lines.append("HRULE:%s%s" % (maxval, color))
             elif minval > maxval:
-                gopts.append(
+                lines.append(
                     "HRULE:%s%s:%s between %s and %s\\j" %
                     (minval, color, self.getNames(relatedGps), maxstr, minstr))
-                gopts.append("HRULE:%s%s" % (maxval, color))
+                lines.append("HRULE:%s%s" % (maxval, color))
         elif minval is not None:
-            gopts.append(
+            lines.append(
                 "HRULE:%s%s:%s less than %s\\j" %
                 (minval, color, self.getNames(relatedGps), minstr))
         elif maxval is not None:
-            gopts.append(
+            lines.append(
                 "HRULE:%s%s:%s greater than %s\\j" %
                 (maxval, color, self.getNames(relatedGps), maxstr))
-
-        return gopts
+        return tuple(lines)
 
     def getNames(self, relatedGps):
         names = sorted(set(x.split('_', 1)[1] for x in self.dataPointNames))
@@ -530,5 +862,5 @@ class HystThresholdInstance(RRDThresholdInstance):
     def _checkImpl(self, dataPoint, value):
         return self.checkRange(dataPoint, value)
 
-from twisted.spread import pb
+
 pb.setUnjellyableForClass(HystThresholdInstance, HystThresholdInstance)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+__doc__ = """hystbench
+Benchmark of the HystThresholdInstance hot path that runs without Zenoss.
+
+The Zenoss modules the threshold imports are replaced by small stand-ins
+(RRDThresholdInstance, ThresholdContext, zenPath, atomicWrite, ...), and
+zenPath points at a scratch directory.  Every scenario feeds synthetic
+values for many devices and datapoints through checkRange() and reports
+throughput, per-sample latency percentiles, object allocations and file
+system operations as JSON.
+
+    python benchmarks/hystbench.py --devices 500 --cycles 20 -o bench.json
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import tempfile
+import platform
+import threading
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Counters updated by the stand-ins below.
+fsops = {'files_written': 0, 'bytes_written': 0, 'files_read': 0,
+         'store_reads': 0, 'store_transactions': 0, 'rows_written': 0}
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        if parent not in sys.modules:
+            _module(parent)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+class RRDThresholdInstance(object):
+
+    def __init__(self, id, context, dpNames, eventClass, severity):
+        self.id = id
+        self._context = context
+        self.dataPointNames = dpNames
+        self.eventClass = eventClass
+        self.severity = severity
+
+    def name(self):
+        return self.id
+
+    def context(self):
+        return self._context
+
+
+class ThresholdContext(object):
+
+    def __init__(self, context):
+        self.deviceName, self.componentName = context
+        self.deviceUrl = '/zport/dmd/Devices/devices/%s' % self.deviceName
+        self.devicePath = '/Devices/Server/Linux'
+
+    def key(self):
+        return self.deviceName, self.componentName
+
+
+class Deferred(object):
+
+    def __init__(self):
+        self.callbacks = []
+
+    def addBoth(self, f):
+        self.callbacks.append(f)
+        return self
+
+    def fire(self, result):
+        for f in self.callbacks:
+            result = f(result)
+
+
+class Reactor(object):
+    """Only remembers delayed calls; the benchmark decides when they run.
+    Functions given to deferToThread() run in real threads, which are
+    waited for on the next runPending().
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.threads = []
+
+    def callLater(self, delay, f, *args, **kw):
+        call = (f, args, kw)
+        self.calls.append(call)
+        return call
+
+    def addSystemEventTrigger(self, *args, **kw):
+        pass
+
+    def deferToThread(self, f, *args, **kw):
+        d = Deferred()
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(f(*args, **kw)))
+        thread.start()
+        self.threads.append((thread, d, result))
+        return d
+
+    def runPending(self):
+        while self.threads:
+            threads, self.threads = self.threads, []
+            for thread, d, result in threads:
+                thread.join()
+                d.fire(result and result[0])
+        calls, self.calls = self.calls, []
+        for f, args, kw in calls:
+            f(*args, **kw)
+
+
+# $ZENHOME of the stand-in zenPath, a new directory per scenario.
+home = {'path': None}
+
+
+def installStubs():
+    def zenPath(*parts):
+        return os.path.join(home['path'], *parts)
+
+    def atomicWrite(filename, data, raiseException=True, createDir=False):
+        fsops['files_written'] += 1
+        fsops['bytes_written'] += len(data)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(filename + '.tmp', filename)
+
+    def nanToNone(value):
+        return None if value != value else value
+
+    def talesEval(express, context, extra=None):
+        return eval(express.split(':', 1)[1], {'here': context})
+
+    class ThresholdClass(object):
+        _properties = ()
+
+    class Permissions(object):
+        view = 'View'
+
+    _module('Products.ZenUtils.Utils', zenPath=zenPath,
+            atomicWrite=atomicWrite, unused=lambda *args: None,
+            nanToNone=nanToNone)
+    _module('Products.ZenModel.ThresholdInstance',
+            RRDThresholdInstance=RRDThresholdInstance,
+            ThresholdContext=ThresholdContext)
+    _module('Products.ZenModel.ThresholdClass', ThresholdClass=ThresholdClass)
+    _module('Products.ZenEvents.Event', Clear=0)
+    _module('Products.ZenEvents.ZenEventClasses', Perf_Snmp='/Perf/Snmp')
+    _module('Products.ZenEvents.Exceptions',
+            pythonThresholdException=Exception,
+            rpnThresholdException=Exception)
+    _module('Products.ZenUtils.ZenTales', talesEval=talesEval,
+            talesEvalStr=lambda express, context, extra=None: express)
+    _module('Products.ZenRRD.utils', rpneval=lambda value, rpn: value)
+    _module('Products.CMFCore.DirectoryView',
+            registerDirectory=lambda *args: None)
+    _module('AccessControl', Permissions=Permissions)
+    _module('Globals', InitializeClass=lambda cls: None)
+    _module('twisted.spread.pb', setUnjellyableForClass=lambda *args: None)
+    reactor = Reactor()
+    _module('twisted.internet.reactor')
+    sys.modules['twisted.internet.reactor'] = reactor
+    sys.modules['twisted.internet'].reactor = reactor
+    _module('twisted.internet.threads', deferToThread=reactor.deferToThread)
+    sys.path.insert(0, ROOT)
+    return reactor
+
+
+def countStoreOperations(HystStore):
+    """Wrap the store classes so reads and writes get counted.
+    """
+    def counted(cls, name, counter):
+        method = getattr(cls, name)
+
+        def wrapper(self, *args, **kw):
+            fsops[counter] += 1
+            return method(self, *args, **kw)
+        setattr(cls, name, wrapper)
+
+    counted(HystStore.PickleFileStore, '_read', 'files_read')
+    counted(HystStore.SqliteStore, '_load', 'store_reads')
+    counted(HystStore.JournalStore, '_load', 'store_reads')
+    counted(HystStore.JournalStore, '_append', 'store_transactions')
+    save = HystStore.SqliteStore.save
+
+    def saveRows(self, records):
+        rows = sum(len(record[-1]) for record in records)
+        if rows:
+            fsops['store_transactions'] += 1
+            fsops['rows_written'] += rows
+        return save(self, records)
+    HystStore.SqliteStore.save = saveRows
+
+
+def signal(kind, rnd):
+    """Value generator for one datapoint.  The threshold is 20..80.
+    """
+    if kind == 'steady':
+        return lambda: rnd.uniform(30, 70)
+    if kind == 'broken':
+        return lambda: rnd.uniform(85, 95)
+    if kind == 'flapping':
+        state = [False]
+
+        def flap():
+            if rnd.random() < 0.3:
+                state[0] = not state[0]
+            return rnd.uniform(85, 95) if state[0] else rnd.uniform(30, 70)
+        return flap
+    # mixed: mostly steady datapoints with some flapping ones
+    return signal(rnd.choice(['steady'] * 8 + ['flapping', 'broken']), rnd)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def runScenario(H, HystStore, HystState, reactor, options, mnk, kind, state,
+                zenhome):
+    """state is 'cold' for a restarted daemon, 'preloaded' for one that
+    preloaded its state before the first cycle, 'rebuilt' for instances
+    replaced by a config push and 'warm' for instances already in use.
+    """
+    M, N, K = mnk
+    rnd = random.Random(options.seed)
+    home['path'] = tempfile.mkdtemp(dir=zenhome)
+    os.makedirs(os.path.join(home['path'], 'var'))
+    # Every scenario starts like a new daemon on an empty $ZENHOME.
+    HystState.registry.clear()
+    if HystState.stateWriter._store is not None:
+        HystState.stateWriter._store.close()
+    HystState.stateWriter._store = HystStore.STORES[options.store]()
+    dps = ['ds_dp%d' % i for i in range(options.datapoints)]
+
+    def build():
+        return [H.HystThresholdInstance(
+            'hyst', ThresholdContext(('dev%d' % d, 'comp')), dps,
+            minval=20, maxval=80, badCount=N, queueSize=M, goodCount=K,
+            eventClass='/Perf', severity=4, escalateCount=3)
+            for d in range(options.devices)]
+
+    instances = build()
+    signals = [[signal(kind, rnd) for dp in dps] for i in instances]
+    # Seed the store so that loading has something to read.
+    for instance, gens in zip(instances, signals):
+        for dp, gen in zip(dps, gens):
+            for i in range(M):
+                instance.checkRange(dp, gen())
+    HystState.stateWriter.flush()
+    if state in ('cold', 'preloaded'):
+        HystState.registry.clear()
+    if state == 'preloaded':
+        HystState.registry.preload()
+    if state == 'warm':
+        for instance in instances:
+            instance.ensureHystState()
+    else:
+        instances = build()
+    for counter in fsops:
+        fsops[counter] = 0
+
+    latencies = []
+    events = 0
+    timer = time.time
+    gc.collect()
+    gc.disable()
+    allocated = gc.get_count()[0]
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = timer()
+    for cycle in range(options.cycles):
+        for instance, gens in zip(instances, signals):
+            for dp, gen in zip(dps, gens):
+                value = gen()
+                before = timer()
+                events += len(instance.checkRange(dp, value))
+                latencies.append(timer() - before)
+        if (cycle + 1) % options.flush_cycles == 0:
+            reactor.runPending()
+    reactor.runPending()
+    reactor.runPending()
+    HystState.stateWriter.flush()
+    elapsed = timer() - started
+    allocated = gc.get_count()[0] - allocated
+    if tracemalloc is not None:
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    gc.enable()
+
+    samples = len(latencies)
+    latencies.sort()
+    result = {
+        'M': M, 'N': N, 'K': K, 'signal': kind,
+        'state': state,
+        'devices': options.devices, 'datapoints': options.datapoints,
+        'cycles': options.cycles, 'samples': samples, 'events': events,
+        'seconds': elapsed,
+        'samples_per_second': samples / elapsed if elapsed else 0.0,
+        'latency_us': dict(
+            (name, percentile(latencies, fraction) * 1e6)
+            for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99), ('max', 1.0))),
+        # Net change of gc-tracked objects, a cheap allocation measure that
+        # also works on the Python 2 that Zenoss ships.
+        'gc_objects_per_sample': allocated / float(samples),
+    }
+    if tracemalloc is not None:
+        result['traced_bytes'] = traced
+        result['traced_peak_bytes'] = peak
+    result.update(fsops)
+    ops = sum(fsops[name] for name in
+              ('files_written', 'files_read', 'store_reads',
+               'store_transactions'))
+    result['fs_ops_per_sample'] = ops / float(samples)
+    return result
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--devices', type='int', default=200)
+    parser.add_option('--datapoints', type='int', default=4)
+    parser.add_option('--cycles', type='int', default=20)
+    parser.add_option('--flush-cycles', type='int', default=5,
+                      help='polling cycles per state flush (default 5)')
+    parser.add_option('--mnk', default='12,7,6;60,30,20;300,150,100',
+                      help='semicolon separated M,N,K triples')
+    parser.add_option('--signals', default='steady,flapping,mixed')
+    parser.add_option('--states', default='cold,preloaded,rebuilt,warm')
+    parser.add_option('--store', default='sqlite',
+                      help='hysteresis state store to use')
+    parser.add_option('--event-refresh', type='float',
+                      help='seconds before a repeated event is sent again,'
+                           ' 0 sends every event (default from'
+                           ' ZENHYST_EVENT_REFRESH)')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('-o', '--output', help='JSON file, default stdout')
+    options, args = parser.parse_args(argv)
+
+    if options.store == 'service':
+        # Without a service to talk to, use the local stand-in.
+        os.environ.setdefault('ZENHYST_SERVICE', 'file://')
+    zenhome = tempfile.mkdtemp(prefix='hystbench')
+    try:
+        reactor = installStubs()
+        from ZenPacks.community.snmp.HysteresisThreshold import HystStore
+        from ZenPacks.community.snmp.HysteresisThreshold import HystState
+        from ZenPacks.community.snmp.HysteresisThreshold.thresholds \
+            import HystThreshold as H
+        countStoreOperations(HystStore)
+        if options.event_refresh is not None:
+            H.EVENT_REFRESH = options.event_refresh
+        results = []
+        for mnk in options.mnk.split(';'):
+            mnk = tuple(int(n) for n in mnk.split(','))
+            for kind in options.signals.split(','):
+                for state in options.states.split(','):
+                    result = runScenario(H, HystStore, HystState, reactor,
+                                         options, mnk, kind, state, zenhome)
+                    results.append(result)
+                    sys.stderr.write(
+                        'M=%(M)d N=%(N)d K=%(K)d %(signal)s %(state)s: '
+                        '%(samples_per_second).0f samples/s, '
+                        'p99 %(p99).1fus, %(fs).4f fs ops/sample\n' % dict(
+                            result, p99=result['latency_us']['p99'],
+                            fs=result['fs_ops_per_sample']))
+    finally:
+        shutil.rmtree(zenhome, ignore_errors=True)
+
+    report = {
+        'benchmark': 'hystbench',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'store': options.store,
+        'event_refresh': H.EVENT_REFRESH,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,9 @@ PREV_ZENPACK_NAME = ""
 ################################
 # Zenoss will not overwrite any changes you make below here.
 
-import os
-from subprocess import Popen, PIPE
-from setuptools import setup, find_packages
+import os  # noqa: E402
+from subprocess import Popen, PIPE  # noqa: E402
+from setuptools import setup, find_packages  # noqa: E402
 
 # Run "make build" if a GNUmakefile is present.
 if os.path.isfile('GNUmakefile'):
@@ -63,7 +63,7 @@ setup(
 
     # The MANIFEST.in file is the recommended way of including additional files
     # in your ZenPack. package_data is another.
-    #package_data = {}
+    # package_data = {}
 
     # Indicate dependencies on other python modules or ZenPacks.  This line
     # is modified by zenoss when the ZenPack edit page is submitted.  Zenoss
@@ -77,6 +77,9 @@ setup(
     # of this form.
     entry_points={
         'zenoss.zenpacks': '%s = %s' % (NAME, NAME),
+        'console_scripts': [
+            'zenhysttune = %s.HystTune:main' % NAME,
+        ],
     },
 
     # All ZenPack eggs must be installed in unzipped form.